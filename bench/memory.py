@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# encoding=utf-8
+
+"""
+Measures the memory taken by parsed tasks.
+
+Parses 10k and 100k generated completed tasks and prints how much the
+resident set grew, per task, for Task records and for plain dicts with
+unicode values, which is how tasks were kept before record.py.  Each
+measurement runs in a separate process, so that memory freed by one isn't
+reused by the next.  Linux only (reads /proc/self/statm).  Run by hand
+after changing record.py or Task.FIELDS:
+
+    python bench/memory.py [count...]
+"""
+
+import gc
+import os
+import resource
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "src"))
+
+from taskindicator.database_tw import parse_line
+
+
+COUNTS = (10000, 100000)
+KINDS = ("record", "dict")
+
+
+def get_rss():
+    with open("/proc/self/statm", "rb") as f:
+        pages = int(f.read().split()[1])
+    return pages * resource.getpagesize()
+
+
+def generate(count):
+    return ['[description:"Fix bug %d in the thing" end:"13820%05d"'
+            ' entry:"13800%05d" modified:"13820%05d" priority:"%s"'
+            ' project:"proj.%d" status:"completed" tags:"home,t%d"'
+            ' uuid:"%08x-1111-2222-3333-444455556666"]'
+            % (n, n % 100000, n % 100000, n % 100000, "HML"[n % 3], n % 13,
+               n % 5, n) for n in xrange(count)]
+
+
+def as_dict(task):
+    """The task as a dict with unicode values and tags in a list."""
+    values = {}
+    for k, v in task.items():
+        if isinstance(v, tuple):
+            v = [unicode(tag) for tag in v]
+        else:
+            v = unicode(v)
+        values[k] = v
+    return values
+
+
+def measure(kind, count):
+    """Returns RSS growth per task, in bytes."""
+    lines = generate(count)
+    gc.collect()
+    before = get_rss()
+
+    if kind == "dict":
+        tasks = [as_dict(parse_line(line)) for line in lines]
+    else:
+        tasks = [parse_line(line) for line in lines]
+    for task in tasks:
+        task["urgency"] = 1.5
+
+    gc.collect()
+    return (get_rss() - before) / len(tasks)
+
+
+def main():
+    if len(sys.argv) == 3 and sys.argv[1] in KINDS:
+        print(measure(sys.argv[1], int(sys.argv[2])))
+        return
+
+    counts = [int(arg) for arg in sys.argv[1:]] or COUNTS
+    for count in counts:
+        results = []
+        for kind in KINDS:
+            output = subprocess.check_output([sys.executable, __file__,
+                                              kind, str(count)])
+            results.append("%s %s" % (kind, output.strip()))
+        print("%d tasks: %s bytes per task" % (count, ", ".join(results)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# encoding=utf-8
+
+"""
+Compares parse_line with the shlex based parser it replaced.
+
+Generates a pending.data with 100k tasks (URLs, quotes and non-ASCII text
+in some descriptions, the way TaskWarrior writes them), parses it both
+ways, prints the times and checks that the tasks are identical.  Run by
+hand after changing parse_line:
+
+    python bench/parse_lines.py [count]
+"""
+
+import os
+import shlex
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "src"))
+
+from taskindicator.database_tw import Task, parse_line
+
+
+COUNT = 100000
+
+
+def parse_shlex(line):
+    """The parser parse_line replaced.  It doesn't decode \\uXXXX escapes
+    or brackets, so the generated file has none."""
+    task = Task()
+    for kw in shlex.split(line[1:-1]):
+        k, v = kw.split(":", 1)
+        v = v.replace("\\/", "/")
+        v = v.decode("utf-8")
+        if k == "tags":
+            v = v.split(",")
+        task[k] = v
+    return task
+
+
+def generate(path, count):
+    with open(path, "wb") as f:
+        for n in xrange(count):
+            description = "Fix bug %d" % n
+            if n % 3 == 0:
+                description += " in http:\\/\\/example.com\\/issues\\/%d" % n
+            if n % 7 == 0:
+                description += " \\\"caf\xc3\xa9\\\""
+            f.write('[description:"%s" entry:"13800%05d" modified:"13810%05d"'
+                    ' priority:"%s" project:"proj.%d" status:"pending"'
+                    ' tags:"home,t%d" uuid:"%08x-1111-2222-3333-444455556666"]'
+                    '\n' % (description, n % 100000, n % 100000, "HML"[n % 3],
+                            n % 13, n % 5, n))
+
+
+def measure(parse, lines):
+    start = time.time()
+    tasks = [parse(line) for line in lines]
+    return tasks, time.time() - start
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else COUNT
+
+    fd, path = tempfile.mkstemp(suffix=".data")
+    os.close(fd)
+    try:
+        generate(path, count)
+        with open(path, "rb") as f:
+            lines = [line.rstrip("\n") for line in f]
+    finally:
+        os.unlink(path)
+
+    old, old_time = measure(parse_shlex, lines)
+    new, new_time = measure(parse_line, lines)
+    print("%d tasks: shlex %.2fs, parse_line %.2fs (%.1fx)"
+          % (count, old_time, new_time, old_time / new_time))
+
+    different = [n for n, (a, b) in enumerate(zip(old, new))
+                 if a.dump() != b.dump()]
+    if different:
+        n = different[0]
+        print("%d tasks differ, e.g. line %d:\n  %s\n  %r\n  %r"
+              % (len(different), n + 1, lines[n], old[n], new[n]))
+        sys.exit(1)
+    print("All tasks are identical.")
+
+
+if __name__ == "__main__":
+    main()
@@ -54,7 +54,7 @@ setup(
     name = 'task-indicator',
     package_dir = {'': 'src'},
     packages = ['taskindicator'],
-    requires = ['gtk', 'json', 'dateutil'],
+    requires = ['gtk', 'json'],
     scripts = ['task-indicator'],
     url = 'http://umonkey.net/task-indicator/en/',
     download_url = 'http://code.umonkey.net/task-indicator/archive/default.zip',
@@ -0,0 +1,93 @@
+# encoding=utf-8
+
+"""
+Persistent cache of parsed data files.
+
+Parsed tasks are saved under ~/.cache/task-indicator/ (or $XDG_CACHE_HOME),
+one file per data file, in marshal format, which loads much faster than
+the data files can be parsed.  Cache files are memory-mapped on load.  The
+cached state includes the inode, size, mtime and line offsets of the data
+file, so that if the file changed since, only the changes are parsed (see
+database_tw.DataFile).
+"""
+
+import hashlib
+import marshal
+import mmap
+import os
+
+from taskindicator import util
+
+
+VERSION = 1
+
+
+def get_folder():
+    base = os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "task-indicator")
+
+
+def get_filename(path):
+    """Returns the cache file name for a data file."""
+    key = hashlib.md5(os.path.abspath(path)).hexdigest()[:8]
+    name = "%s-%s.cache" % (key, os.path.basename(path))
+    return os.path.join(get_folder(), name)
+
+
+def get_hash_check():
+    """Line hashes are only usable if the hash function didn't change, e.g.
+    with PYTHONHASHSEED."""
+    return hash("task-indicator")
+
+
+def load(path):
+    """Returns the saved state of the data file, or None."""
+    filename = get_filename(path)
+    if not os.path.exists(filename):
+        return None
+
+    try:
+        with open(filename, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                state = marshal.loads(data)
+            finally:
+                data.close()
+    except (EnvironmentError, EOFError, ValueError, TypeError), e:
+        util.log("Error reading cache file {0}: {1}", filename, e)
+        return None
+
+    if not isinstance(state, dict) or state.get("version") != VERSION:
+        util.log("Cache file {0} is outdated.", filename)
+        return None
+
+    if state.get("hash") != get_hash_check():
+        util.log("Cache file {0} was made with a different hash.", filename)
+        return None
+
+    return state
+
+
+def save(path, state):
+    """Saves the state of the data file.  Writes to a temporary file first,
+    so that a crash never leaves a broken cache."""
+    filename = get_filename(path)
+
+    state = dict(state)
+    state["version"] = VERSION
+    state["hash"] = get_hash_check()
+
+    try:
+        folder = os.path.dirname(filename)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        tmp = "%s.%u.tmp" % (filename, os.getpid())
+        with open(tmp, "wb") as f:
+            marshal.dump(state, f, 2)
+        os.rename(tmp, filename)
+    except EnvironmentError, e:
+        util.log("Error writing cache file {0}: {1}", filename, e)
+        return False
+
+    return True
@@ -1,11 +1,15 @@
 # vim: set fileencoding=utf-8 tw=0:
 
+import contextlib
 import os
 import time
 
 import sqlite3
 
+from taskindicator import recent
+from taskindicator import search
 from taskindicator import util
+from taskindicator.record import Record, intern_string, timestamp
 
 
 DATABASE_PATH = "~/.task/tasks.sqlite"
@@ -30,10 +34,24 @@ CREATE TABLE IF NOT EXISTS changes (
   status VARCHAR(255) NOT NULL,
   duration INTEGER UNSIGNED NULL
 );
+
+CREATE INDEX IF NOT EXISTS tasks_modified ON tasks (modified);
 """
 
 
-class Task(dict):
+class Task(Record):
+    FIELDS = ("id", "created", "modified", "project", "summary", "status",
+              "priority", "description")
+    __slots__ = ("db", ) + tuple("_" + f for f in FIELDS)
+    ATTRS = dict((f, "_" + f) for f in FIELDS)
+
+    CONVERTERS = {
+        "created": timestamp,
+        "modified": timestamp,
+        "project": intern_string,
+        "status": intern_string,
+    }
+
     def __getitem__(self, k):
         if k == "urgency":
             return 1
@@ -71,7 +89,7 @@ class Task(dict):
     def get_start_ts(self):
         last = self.db.get_last_change(self.id())
         if last and last["status"] == "started":
-            return int(last["ts"])
+            return last["ts"]
 
     def is_closed(self):
         return self["status"] in ("deleted", "completed")
@@ -84,6 +102,9 @@ class Database(object):
     def __init__(self):
         self.filename = os.path.expanduser(DATABASE_PATH)
         self.conn = self.connect(self.filename)
+        self._batch_depth = 0
+        self.listeners = []
+        self.notes = search.TokenIndex()
 
     def connect(self, filename):
         conn = sqlite3.connect(filename)
@@ -92,23 +113,79 @@ class Database(object):
         conn.commit()
         return conn
 
-    def modified_since(self, ts):
-        return os.stat(self.filename).st_mtime > ts
+    def commit(self):
+        if not self._batch_depth:
+            self.conn.commit()
+            self.notify()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Groups changes into a single transaction."""
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            self.commit()
+
+    def get_watch_files(self):
+        return [self.filename]
+
+    def add_listener(self, func):
+        self.listeners.append(func)
+
+    def notify(self):
+        for func in self.listeners:
+            func()
 
     def refresh(self):
+        """Tasks are always read from the database, only tells the
+        listeners."""
+        self.notify()
+
+    def save_cache(self):
+        pass
+
+    def apply_delta(self, data):
+        return False
+
+    def get_queue_depth(self):
+        return 0
+
+    def flush(self):
         pass
 
-    def get_tasks(self):
+    def get_tasks(self, closed=False):
         """
-        Returns a list of task objects.
+        Returns a list of task objects.  Completed and deleted tasks are
+        only included with closed=True.
         """
         cur = self.conn.cursor()
-        cur.execute("SELECT id, created, modified, project, summary, status, priority, description FROM tasks")
+        if closed:
+            cur.execute("SELECT id, created, modified, project, summary, status, priority, description FROM tasks")
+        else:
+            cur.execute("SELECT id, created, modified, project, summary, status, priority, description FROM tasks WHERE status NOT IN ('completed', 'deleted')")
         rows = cur.fetchall()
 
         header = ["id", "created", "modified", "project", "summary", "status", "priority", "description"]
         return [Task.from_row(zip(header, row), self) for row in rows]
 
+    def get_recent_tasks(self, count):
+        """Returns the count most recently modified open tasks, newest
+        first."""
+        cur = self.conn.cursor()
+        cur.execute("SELECT id, created, modified, project, summary, status, priority, description FROM tasks WHERE status NOT IN ('completed', 'deleted') ORDER BY modified DESC LIMIT ?", (count, ))
+        rows = cur.fetchall()
+
+        header = ["id", "created", "modified", "project", "summary", "status", "priority", "description"]
+        return [Task.from_row(zip(header, row), self) for row in rows]
+
+    def get_project_index(self):
+        """Returns open tasks by project, see recent.ProjectIndex."""
+        index = recent.ProjectIndex()
+        index.rebuild(self.get_tasks())
+        return index
+
     def add_task(self, data):
         ts = int(time.time())
 
@@ -126,10 +203,11 @@ class Database(object):
 
         cur.execute("INSERT INTO tasks (created, modified, project, summary, priority, status, description) VALUES (?, ?, ?, ?, ?, ?, ?)", (params["created"], params["modified"], params["project"], params["summary"], params["priority"], params["status"], params["description"]))
         task_id = cur.lastrowid
+        self.notes.update(str(task_id), params["description"])
 
         cur.execute("INSERT INTO changes (task_id, ts, status, duration) VALUES (?, ?, ?, ?)", (task_id, ts, params["status"], 0))
 
-        self.conn.commit()
+        self.commit()
 
     def update_task(self, task_id, properties):
         ts = int(time.time())
@@ -144,10 +222,26 @@ class Database(object):
         cur = self.conn.cursor()
 
         cur.execute("UPDATE tasks SET modified = ?, project = ?, summary = ?, priority = ?, status = ?, description = ? WHERE id = ?", (params["modified"], params["project"], params["summary"], params["priority"], params["status"], params["description"], task_id))
+        self.notes.update(str(task_id), params["description"])
 
         cur.execute("INSERT INTO changes (task_id, ts, status, duration) VALUES (?, ?, ?, ?)", (task_id, ts, params["status"], 0))
 
-        self.conn.commit()
+        self.commit()
+
+    def index_notes(self, callback=None):
+        def load():
+            conn = sqlite3.connect(self.filename)
+            try:
+                rows = conn.execute("SELECT id, description FROM tasks "
+                                    "WHERE description IS NOT NULL")
+                return [(str(row[0]), row[1]) for row in rows]
+            finally:
+                conn.close()
+
+        self.notes.build(load, callback)
+
+    def search_notes(self, query):
+        return self.notes.search(query)
 
     def get_projects(self):
         projects = {}
@@ -188,13 +282,13 @@ class Database(object):
         if last is not None:
             if status == last["status"]:
                 return  # no changes
-            duration = ts - int(last["ts"])
+            duration = ts - last["ts"]
             cur.execute("UPDATE changes SET duration = ? WHERE id = ?", (duration, last["id"]))
             util.log("Task {0} spent {1} seconds in status {2}, switching to {3}.", task_id, duration, last["status"], status)
 
         cur.execute("UPDATE tasks SET modified = ?, status = ? WHERE id = ?", (ts, status, task_id))
         cur.execute("INSERT INTO changes (task_id, ts, status) VALUES (?, ?, ?)", (task_id, ts, status))
-        self.conn.commit()
+        self.commit()
 
     def get_last_change(self, task_id):
         cur = self.conn.cursor()
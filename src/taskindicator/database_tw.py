@@ -1,50 +1,74 @@
 # encoding=utf-8
 
+import gobject
 import gtk
-import json
+import hashlib
 import os
 import re
-import shlex
 import time
 
+from taskindicator import cache
+from taskindicator import notes
+from taskindicator import recent
+from taskindicator import taskrc
+from taskindicator import urgency
 from taskindicator import util
-
-
-FREQUENCY = 1
+from taskindicator import writer
+from taskindicator.record import (Record, ascii_string, intern_list,
+                                  intern_string, timestamp)
 
 
 def save_note(task_id, note):
-    if isinstance(note, unicode):
-        note = note.encode("utf-8")
-
-    folder = os.path.expanduser("~/.task/notes")
-    if not os.path.exists(folder):
-        os.makedirs(folder)
-
-    path = os.path.join(folder, task_id)
-    with open(path, "wb") as f:
-        f.write(note)
+    notes.get_store().set(task_id, note)
 
 
 def read_note(task_id):
-    folder = os.path.expanduser("~/.task/notes")
-    path = os.path.join(folder, task_id)
-    if os.path.exists(path):
-        with open(path, "rb") as f:
-            f.read(note)
+    return notes.get_store().get(task_id)
 
 
 def get_database_folder():
-    out = util.run_command(["task", "_show"])
-
-    for line in out.split("\n"):
-        if line.startswith("data.location="):
-            return line.split("=", 1)[1]
-
-    raise RuntimeException("Could not find database location.")
+    return taskrc.get_config().get_data_location()
+
+
+class Task(Record):
+    FIELDS = ("uuid", "status", "description", "project", "priority",
+              "tags", "depends", "entry", "modified", "start", "end", "due",
+              "wait", "scheduled", "urgency")
+    __slots__ = tuple("_" + f for f in FIELDS)
+    ATTRS = dict((f, "_" + f) for f in FIELDS)
+
+    CONVERTERS = {
+        "uuid": ascii_string,
+        "status": intern_string,
+        "project": intern_string,
+        "priority": intern_string,
+        "tags": intern_list,
+        "entry": timestamp,
+        "modified": timestamp,
+        "start": timestamp,
+        "end": timestamp,
+        "due": timestamp,
+        "wait": timestamp,
+        "scheduled": timestamp,
+    }
+
+    @classmethod
+    def from_json(cls, data):
+        """Creates a task from the JSON format, which TaskWarrior uses for
+        export and hooks."""
+        data = dict(data)
+        data.pop("id", None)
+        data.pop("urgency", None)
+
+        for note in data.pop("annotations", None) or []:
+            key = "annotation_%u" % timestamp(note["entry"])
+            data[key] = note["description"]
+
+        if isinstance(data.get("depends"), list):
+            data["depends"] = u",".join(data["depends"])
+
+        return cls(data)
 
-
-class Task(dict):
     def __repr__(self):
         s = "<Task {0}".format(self["uuid"][:8])
         s += ", status={0}".format(self["status"])
@@ -60,8 +84,8 @@ class Task(dict):
 
     def __getitem__(self, key):
         if key == "tags":
-            return self.get("tags", [])
-        return super(Task, self).get(key, None)
+            return getattr(self, "_tags", None) or ()
+        return super(Task, self).__getitem__(key)
 
     def id(self):
         return self["uuid"]
@@ -81,13 +105,14 @@ class Task(dict):
         elif "start" in self:
             del self["start"]
 
+    def get_start_ts(self):
+        return self["start"]
+
     def get_current_runtime(self):
-        if not self.get("start"):
+        start = self["start"]
+        if not start:
             return 0
-
-        start = int(self["start"])
-        duration = time.time() - start
-        return int(duration)
+        return int(time.time()) - start
 
     def format_current_runtime(self):
         duration = self.get_current_runtime()
@@ -111,94 +136,428 @@ class Task(dict):
         return self.get("project", None)
 
 
-class Tasks(object):
-    def __init__(self):
+# An attribute of the FF4 format, e.g.: description:"Call \"Bob\"".
+FF4_ATTRIBUTE = re.compile(r'([^\s\[:"]+):"([^"\\]*(?:\\.[^"\\]*)*)"')
+
+# An escape sequence within an attribute value.
+FF4_ESCAPE = re.compile(r'\\(u[0-9a-fA-F]{4}|.)', re.S)
+
+FF4_ESCAPES = {
+    u'"': u'"',
+    u"\\": u"\\",
+    u"/": u"/",
+    u"b": u"\b",
+    u"f": u"\f",
+    u"n": u"\n",
+    u"r": u"\r",
+    u"t": u"\t",
+}
+
+
+def ff4_unescape(m):
+    seq = m.group(1)
+    if len(seq) == 5:
+        return unichr(int(seq[1:], 16))
+    return FF4_ESCAPES.get(seq, seq)
+
+
+def parse_line(line):
+    """
+    Parses a single line of a data file, returns a Task.
+
+    The line looks like [key:"value" key:"value" ...], values are JSON
+    escaped, with brackets encoded as &open; and &close;.  The line is decoded
+    once.  Lines without escapes other than \\/, which is most of them, are
+    split at the quotes with a single call and checked with a few string
+    operations, others are tokenized with a single regular expression.
+    """
+    line = line.decode("utf-8")
+
+    # Slashes are escaped in every URL, unescape them in one go unless there
+    # are escaped backslashes, which makes "\\/" ambiguous.
+    if u"\\/" in line and u"\\\\" not in line:
+        line = line.replace(u"\\/", u"/")
+
+    pairs = None
+    if u"\\" not in line:
+        # [key:"value" key:"value"] => "[key:", value, " key:", value, "]".
+        # Every key part must have a separator before it and a colon after
+        # it, the keys must be non-empty and have no spaces or colons.
+        parts = line.split(u'"')
+        seps = parts[0:-1:2]
+        keys = [k[1:-1] for k in seps]
+        names = u"".join(keys)
+        if len(parts) % 2 and parts[-1] == u"]" and u"" not in keys \
+                and u" " not in names and u":" not in names \
+                and u"".join(seps) == u"[" + u": ".join(keys) + u":":
+            pairs = zip(keys, parts[1::2])
+
+    if pairs is None:
+        pairs = [(k, FF4_ESCAPE.sub(ff4_unescape, v) if u"\\" in v else v)
+                 for k, v in FF4_ATTRIBUTE.findall(line)]
+
+    if u"&" in line:
+        pairs = [(k, v.replace(u"&open;", u"[").replace(u"&close;", u"]"))
+                 for k, v in pairs]
+
+    return Task.from_pairs(pairs)
+
+
+class DataFile(object):
+    """
+    A TaskWarrior data file which is re-read incrementally.
+
+    Remembers the inode, size, a digest of the contents and byte offsets of
+    every line, so that when the file is appended to (completed.data mostly
+    grows at the end) only the new lines are parsed.  When the file was
+    changed in place (TaskWarrior rewrites pending.data), the lines are
+    compared to the previous version and only the changed ones are parsed.
+    If the file was replaced (e.g., by task gc) or truncated, it's parsed
+    from scratch.
+
+    Only parsing is incremental: every refresh still reads and hashes the
+    whole known prefix of the file, so its cost grows with the file size.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.reset()
+
+    def reset(self):
+        self.inode = None
+        self.size = 0
+        self.mtime = None
+        self.digest = None  # md5 of the first size bytes
+        self.offsets = []  # byte offset of every line
+        self.hashes = []  # hash of every line, to detect changes
         self.tasks = []
+        self.dirty = False  # changed since saved to cache
 
-        database_folder = get_database_folder()
+    def load_cache(self):
+        """Restores the state saved with save_cache.  Changes made to the
+        file since then are picked up by the next refresh."""
+        state = cache.load(self.path)
+        if state is None or state.get("fields") != list(Task.FIELDS):
+            return False
 
-        db = os.path.expanduser(os.path.join(database_folder, "pending.data"))
-        self.tasks += self.load_data(db)
+        try:
+            if os.stat(self.path).st_ino != state["inode"]:
+                util.log("Cache of {0} is for another file.", self.path)
+                return False
+        except OSError:
+            return False
 
-        db = os.path.expanduser(os.path.join(database_folder, "completed.data"))
-        self.tasks += self.load_data(db)
+        self.inode = state["inode"]
+        self.size = state["size"]
+        self.mtime = state["mtime"]
+        self.digest = state.get("digest")
+        self.offsets = state["offsets"]
+        self.hashes = state["hashes"]
+        self.tasks = [Task.restore(values) for values in state["tasks"]]
+        self.dirty = False
+
+        util.log("Restored {0} tasks of {1} from cache.",
+                 len(self.tasks), self.path)
+        return True
 
-    def load_data(self, database):
-        """Reads the database file, parses it and returns a list of Task object
-        instances, which contain all parsed data (values are unicode).
+    def save_cache(self):
+        """Saves the parsed tasks to the cache, if they changed."""
+        if not self.dirty or self.inode is None:
+            return
+
+        cache.save(self.path, {
+            "fields": list(Task.FIELDS),
+            "inode": self.inode,
+            "size": self.size,
+            "mtime": self.mtime,
+            "digest": self.digest,
+            "offsets": self.offsets,
+            "hashes": self.hashes,
+            "tasks": [task.dump() for task in self.tasks],
+        })
+        self.dirty = False
 
-        This home-made parser returns raw timestamps, while 'task export'
-        returns formatted UTC based dates which are hard to convert to
-        timestamps to calculate activity duration, etc.
+    def refresh(self):
+        """Reads the changes, if any.  Returns True if the file changed."""
+        if not os.path.exists(self.path):
+            if self.inode is None:
+                util.log("Database {0} does not exist.", self.path)
+                return False
+            util.log("Database {0} disappeared.", self.path)
+            self.reset()
+            return True
+
+        with open(self.path, "rb") as f:
+            st = os.fstat(f.fileno())
+            if st.st_ino == self.inode and st.st_size == self.size \
+                    and st.st_mtime == self.mtime:
+                return False
+
+            if st.st_ino != self.inode or st.st_size < self.size:
+                util.log("Reading {0} from scratch.", self.path)
+                self.reset()
+                self.read_appended(f, hashlib.md5())
+            else:
+                # Only appended to if everything read before is unchanged,
+                # edits can keep the size and the last line.
+                f.seek(0)
+                h = hashlib.md5(f.read(self.size))
+                if st.st_size > self.size and h.hexdigest() == self.digest:
+                    self.read_appended(f, h)
+                else:
+                    self.read_changed(f)
+
+            self.inode = st.st_ino
+            self.mtime = st.st_mtime
+            self.dirty = True
 
-        TODO: find out a way to convert dates like '20130201T103640Z' to UNIX
-        timestamp or at least a datetime.
-        """
-        _start = time.time()
+        return True
 
-        if not os.path.exists(database):
-            util.log("Database {0} does not exist.", database)
-            return {}
+    def is_stale(self):
+        """Returns True if the file changed since it was last read."""
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return self.inode is not None
+        return st.st_ino != self.inode or st.st_size != self.size \
+            or st.st_mtime != self.mtime
+
+    def read_appended(self, f, h):
+        """Parses lines added after the last known position.  h is the md5
+        of the contents up to it."""
+        start = self.size
+        f.seek(start)
+        data = f.read()
+
+        count = len(self.tasks)
+        for offset, line in self.split_lines(data, start):
+            self.offsets.append(offset)
+            self.hashes.append(hash(line))
+            self.tasks.append(self.parse(line))
+
+        h.update(data[:self.size - start])
+        self.digest = h.hexdigest()
+
+        if len(self.tasks) != count:
+            util.log("Read {0} new tasks from {1}.",
+                     len(self.tasks) - count, self.path)
+
+    def read_changed(self, f):
+        """Re-reads a file changed in place.  Lines which were seen before,
+        even if moved, are not parsed again."""
+        known = dict(zip(self.hashes, self.tasks))
+
+        f.seek(0)
+        data = f.read()
+
+        self.size = 0
+        self.offsets = []
+        self.hashes = []
+        self.tasks = []
 
-        with open(database, "rb") as f:
-            raw_data = f.read()
+        parsed = 0
+        for offset, line in self.split_lines(data, 0):
+            h = hash(line)
+            task = known.get(h)
+            if task is None:
+                task = self.parse(line)
+                parsed += 1
+            self.offsets.append(offset)
+            self.hashes.append(h)
+            self.tasks.append(task)
+
+        self.digest = hashlib.md5(data[:self.size]).hexdigest()
+
+        util.log("Parsed {0} changed lines of {1} in {2}.",
+                 parsed, len(self.tasks), self.path)
+
+    def split_lines(self, data, base):
+        """Yields offsets and contents of complete lines.  Updates the size
+        to the end of the last complete line, so that a partially written
+        line is picked up next time."""
+        pos = 0
+        end = len(data)
+        while pos < end:
+            eol = data.find("\n", pos)
+            if eol < 0:
+                # Incomplete last line, unless it looks like a whole record.
+                if not data.endswith("]"):
+                    break
+                eol = end
+
+            line = data[pos:eol]
+            offset = base + pos
+            pos = eol + 1
+            self.size = base + min(pos, end)
+
+            if line.strip():
+                yield offset, line
+
+    def parse(self, line):
+        if not line.startswith("[") or not line.endswith("]"):
+            raise ValueError("Unsupported file format " \
+                "in {0}".format(self.path))
+        return parse_line(line)
+
+
+def has_id(task):
+    """Returns True if TaskWarrior gives the task a short id."""
+    return task["status"] not in ("completed", "deleted")
 
-        tasks = []
-        for line in raw_data.rstrip().split("\n"):
-            if not line.startswith("[") or not line.endswith("]"):
-                raise ValueError("Unsupported file format " \
-                    "in {0}".format(database))
 
-            task = Task()
-            for kw in shlex.split(line[1:-1]):
-                if ":" not in kw:
-                    util.log("Warning: malformed database token: {0}", kw)
-                    continue
-                k, v = kw.split(":", 1)
-                v = v.replace("\/", "/")  # FIXME: must be a better way
-                v = v.decode("utf-8")
-                if k == "tags":
-                    v = v.split(",")
-                task[k] = v
+class Tasks(object):
+    def __init__(self, files=None, cached=False):
+        if files is None:
+            database_folder = get_database_folder()
+            files = [DataFile(os.path.join(database_folder, "pending.data")),
+                     DataFile(os.path.join(database_folder, "completed.data"))]
+            for f in files:
+                f.refresh()
 
-            tasks.append(task)
+        self.tasks = []
+        for f in files:
+            self.tasks += f.tasks
 
-        tasks = self.merge_exported(tasks)
+        urgency.update(self.tasks, cached=cached)
 
-        util.log("Task database read in {0} seconds.", time.time() - _start)
+        # Tasks in pending.data are numbered by their position, the same
+        # way TaskWarrior does it: waiting and recurring ones too, only
+        # completed and deleted tasks (not yet moved) are skipped.
+        self.index = {}
+        self.ids = {}
+        for task in self.tasks:
+            self.index[task["uuid"]] = task
+        if files:
+            for task in files[0].tasks:
+                if has_id(task):
+                    self.ids[len(self.ids) + 1] = task["uuid"]
 
-        return tasks
+    def __iter__(self):
+        return iter(self.tasks)
 
-    def merge_exported(self, tasks):
-        """Merges data reported by task.  This is primarily used to get real
-        urgency, maybe something else in the future."""
-        out = util.run_command(["task", "rc.json.array=1", "export"])
+    def __getitem__(self, key):
+        """Finds a task by uuid or short numeric id."""
+        task = self.index.get(key)
+        if task is None and str(key).isdigit():
+            task = self.index.get(self.ids.get(int(key)))
+        return task
 
-        _tasks = {}
-        for em in json.loads(out):
-            _tasks[em["uuid"]] = em
+    def __len__(self):
+        return len(self.tasks)
 
-        for idx, task in enumerate(tasks):
-            if task["uuid"] not in _tasks:
-                util.log("Warning: task {0} not exported by TaskWarrior.", task["uuid"])
-                continue
+    def replace(self, task):
+        """Replaces a task with a changed copy, or adds a new one."""
+        old = self.index.get(task["uuid"])
+        if old is None:
+            self.tasks.append(task)
+            if has_id(task):
+                self.ids[len(self.ids) + 1] = task["uuid"]
+        else:
+            self.tasks[self.tasks.index(old)] = task
+        self.index[task["uuid"]] = task
 
-            _task = _tasks[task["uuid"]]
-            if "urgency" in _task:
-                tasks[idx]["urgency"] = float(_task["urgency"])
 
-        return tasks
+class Batch(object):
+    """
+    Pending changes to tasks, see Database.batch().
 
-    def __iter__(self):
-        return iter(self.tasks)
+    Changes are merged per task: all modifications into one set, and the
+    last of start, stop and done wins (done stops the task by itself).
+    Tasks with the same action and modifications are then changed with a
+    single command, e.g. "task uuid1 uuid2 uuid3 stop".
+    """
 
-    def __getitem__(self, key):
-        for task in self.tasks:
-            if task["uuid"] == key:
-                return task
+    def __init__(self):
+        self.tasks = []  # task ids, in the order of first change
+        self.actions = {}  # task id => start, stop or done
+        self.modifications = {}  # task id => {property: value}
+
+    def add(self, task_id, action=None, modifications=None):
+        if task_id not in self.modifications:
+            self.tasks.append(task_id)
+            self.modifications[task_id] = {}
+        if action is not None:
+            self.actions[task_id] = action
+        if modifications:
+            self.modifications[task_id].update(modifications)
+
+    def start(self, task_id):
+        self.add(task_id, "start")
+
+    def stop(self, task_id):
+        self.add(task_id, "stop")
+
+    def done(self, task_id):
+        self.add(task_id, "done")
+
+    def modify(self, task_id, modifications):
+        self.add(task_id, modifications=modifications)
+
+    @staticmethod
+    def get_arguments(properties):
+        """Converts task properties to TaskWarrior command arguments."""
+        args = []
+        for k, v in sorted(properties.items()):
+            if v is None:
+                v = ""
+            if k == "summary":
+                args.append(v)
+            elif k == "tags":
+                args += [tag for tag in v if tag.strip()]
+            else:
+                args.append(u"{0}:{1}".format(k, v))
+        return [a.encode("utf-8") if isinstance(a, unicode) else a
+                for a in args]
+
+    def get_commands(self):
+        """Returns the commands to run, with tasks which have identical
+        changes grouped together."""
+        groups = []
+        tasks = {}
+        for task_id in self.tasks:
+            action = self.actions.get(task_id)
+            args = self.get_arguments(self.modifications[task_id])
+            if action is None and not args:
+                continue
 
-    def __len__(self):
-        return len(self.tasks)
+            key = (action, tuple(args))
+            if key not in tasks:
+                groups.append(key)
+                tasks[key] = []
+            tasks[key].append(task_id)
+
+        commands = []
+        for key in groups:
+            action, args = key
+            command = ["task", "rc.bulk=0", "rc.confirmation=off"]
+            command += tasks[key]
+            command.append(action or "mod")
+            command += args
+            commands.append((action, command))
+        return commands
+
+    def run(self):
+        for action, command in self.get_commands():
+            # Stopping tasks which aren't running is not an error.
+            util.run_command(command, fail=action != "stop")
+
+
+class BatchContext(object):
+    def __init__(self, database):
+        self.database = database
+        self.outer = False
+
+    def __enter__(self):
+        if self.database._batch is None:
+            self.database._batch = Batch()
+            self.outer = True
+        return self.database._batch
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.outer:
+            batch, self.database._batch = self.database._batch, None
+            if exc_type is None and batch.get_commands():
+                self.database.submit(batch)
 
 
 class Database(object):
@@ -206,103 +565,396 @@ class Database(object):
         self.filename = self.get_filename()
         self.mtime = None
         self._tasks = None
+        self._batch = None
+
+        # Writes are done in the background, see writer.py.  Errors are
+        # reported to on_error, if set.
+        self.queue = writer.WriteQueue()
+        self.on_error = None
 
-    def modified_since(self, ts):
-        return os.stat(self.filename).st_mtime > ts
+        # Changes are applied to copies of tasks right away, which replace
+        # the originals until the write is done, see apply_batch.
+        self.optimistic = {}  # uuid => changed task
+        self.in_flight = {}  # uuid => number of unfinished writes
+
+        # Tasks received from hooks, which replace the ones read from the
+        # data files until TaskWarrior writes them, see apply_delta.
+        self.deltas = {}  # uuid => task
+
+        # Functions called when tasks change, see add_listener.
+        self.listeners = []
+
+        # Recently modified tasks, for the menu.  Grows if more are asked
+        # for, see get_recent_tasks.
+        self.recent = recent.RecentTasks(10)
+        self.projects = None  # built when asked for, see get_project_index
+
+        # Tasks are first shown with urgency from the cache, which is
+        # recomputed when idle, see load_tasks.
+        self.urgency_source = None
+
+        # Completed and deleted tasks are only loaded when asked for, see
+        # get_tasks.  After that they are kept and refreshed too.
+        folder = os.path.dirname(self.filename)
+        self._completed = DataFile(os.path.join(folder, "completed.data"))
+        self._files = [DataFile(self.filename)]
+        self._files[0].load_cache()
 
     def get_filename(self):
-        for line in util.run_command(["task", "_show"]).split("\n"):
-            if line.startswith("data.location="):
-                folder = line.split("=", 1)[1].strip()
-                return os.path.expanduser(os.path.join(folder,
-                    "pending.data"))
-        raise RuntimeError("Could not find task database location.")
-
-    def get_tasks(self):
+        return os.path.join(get_database_folder(), "pending.data")
+
+    def get_watch_files(self):
+        """Returns the files which are changed by TaskWarrior."""
+        folder = os.path.dirname(self.filename)
+        return [os.path.join(folder, name) for name in
+                ("pending.data", "completed.data", "undo.data",
+                 "backlog.data")]
+
+    def get_tasks(self, closed=False):
+        """Returns pending tasks.  With closed=True, completed and deleted
+        tasks are loaded too; once they are loaded, they're always
+        returned."""
+        if closed and self._completed not in self._files:
+            util.log("Loading completed tasks.")
+            self._completed.load_cache()
+            self._files.append(self._completed)
+            self._tasks = None
+
         if self._tasks is None:
             util.log("Reloading tasks.")
             self._tasks = self.load_tasks()
         return self._tasks
 
+    def has_closed(self):
+        """Returns True if completed tasks are loaded."""
+        return self._completed in self._files
+
+    def index_notes(self, callback=None):
+        """Starts indexing notes for search_notes, callback is called when
+        done."""
+        notes.get_store().build_search_index(callback)
+
+    def search_notes(self, query):
+        """Returns uuids of tasks with notes which have all words of the
+        query (as prefixes)."""
+        return notes.get_store().search(query)
+
+    def get_recent_tasks(self, count):
+        """Returns the count most recently modified pending tasks, newest
+        first."""
+        tasks = self.get_tasks()
+        if count > self.recent.size or self.recent.stale:
+            self.recent.size = max(count, self.recent.size)
+            self.recent.rebuild(tasks.tasks)
+        return self.recent.get(count)
+
+    def get_project_index(self):
+        """Returns open tasks by project, see recent.ProjectIndex."""
+        tasks = self.get_tasks()
+        if self.projects is None:
+            self.projects = recent.ProjectIndex()
+            self.projects.rebuild(tasks.tasks)
+        return self.projects
+
     def get_projects(self):
         projects = {}
         for task in self.get_tasks():
             projects[task["project"]] = True
         return projects.keys()
 
+    def add_listener(self, func):
+        """Adds a function to call when tasks change, either because the
+        database changed, or because of changes made by the indicator."""
+        self.listeners.append(func)
+
+    def notify(self):
+        for func in self.listeners:
+            func()
+
     def refresh(self):
-        self._tasks = None
-        return self.get_tasks()
+        """Reloads tasks if the database changed, notifies listeners."""
+        if self.is_stale():
+            self._tasks = self.load_tasks()
+            self.notify()
+        return self._tasks
 
     def load_tasks(self):
-        return Tasks()
+        _start = time.time()
+
+        for f in self._files:
+            f.refresh()
+
+        # On the first load, urgency is taken from the cache to show the
+        # menu sooner, and recomputed when idle, see on_idle_urgency.
+        cached = self._tasks is None
+        tasks = Tasks(self._files, cached=cached)
+        if cached and self.urgency_source is None:
+            self.urgency_source = gobject.idle_add(self.on_idle_urgency)
+
+        # Deltas are dropped once TaskWarrior wrote them.  Tasks which were
+        # closed or purged are not in the loaded files, but were written if
+        # pending.data was written after they changed.
+        written = self._files[0].mtime
+        for uuid, task in self.deltas.items():
+            old = tasks[uuid]
+            if old is not None and old["modified"] >= task["modified"]:
+                del self.deltas[uuid]
+            elif old is None and written is not None \
+                    and written >= task["modified"]:
+                util.log("Task {0} left pending.data.", uuid)
+                del self.deltas[uuid]
+            else:
+                tasks.replace(task)
+
+        # Changes which are not written yet.
+        for task in self.optimistic.values():
+            tasks.replace(task)
+
+        if self.deltas or self.optimistic:
+            urgency.update(tasks.tasks)
+
+        self.recent.rebuild(tasks.tasks)
+        self.projects = None
+
+        util.log("Task database read in {0} seconds.", time.time() - _start)
+        return tasks
+
+    def on_idle_urgency(self):
+        """Recomputes urgency of tasks loaded with cached values."""
+        self.urgency_source = None
+        if self._tasks is not None:
+            _start = time.time()
+            urgency.update(self._tasks.tasks)
+            util.log("Urgency updated in {0} seconds.", time.time() - _start)
+            self.notify()
+        return False
+
+    def save_cache(self):
+        """Saves parsed tasks for faster startup."""
+        for f in self._files:
+            f.save_cache()
+
+    def is_stale(self):
+        """Returns True if the loaded tasks are out of date."""
+        if self._tasks is None:
+            return True
+        return any(f.is_stale() for f in self._files)
 
     def get_task_info(self, task_id):
-        return Tasks()[task_id]
+        """Returns the task with the specified uuid or id.  The database is
+        only read if it changed."""
+        task = self.refresh()[task_id]
+        if task is None and not self.has_closed():
+            task = self.get_tasks(closed=True)[task_id]
+        return task
+
+    def apply_delta(self, data):
+        """Applies a task received from a TaskWarrior hook (see hook.py),
+        without reading the database.  Returns True if the task was
+        applied."""
+        if self._tasks is None:
+            return False
+
+        task = Task.from_json(data)
+        if task["uuid"] in self.in_flight:
+            return False  # ours, checked by reconcile
+
+        util.log("Task {0} changed, status={1}.", task["uuid"],
+                 task["status"])
+        self.deltas[task["uuid"]] = task
+        self._tasks.replace(task)
+        self.recent.update(task)
+        if self.projects is not None:
+            self.projects.update(task)
+        urgency.update(self._tasks.tasks)
+        self.notify()
+        return True
+
+    def submit(self, batch):
+        """Applies the changes to loaded tasks, then writes them in the
+        background."""
+        uuids = self.apply_batch(batch)
+        self.queue.submit(batch.run,
+            callback=lambda result: self.reconcile(uuids),
+            errback=lambda e: self.reconcile(uuids, e))
+
+    def apply_batch(self, batch):
+        """Applies the changes to copies of the loaded tasks, so that the
+        menu, status and search dialog are updated before TaskWarrior is
+        done.  Returns uuids of the changed tasks."""
+        tasks = self.get_tasks()
+        now = int(time.time())
+
+        uuids = []
+        for task_id in batch.tasks:
+            task = tasks[task_id]
+            if task is None:
+                continue
+            task = task.copy()
+
+            for k, v in batch.modifications[task_id].items():
+                if isinstance(v, str):
+                    v = v.decode("utf-8")
+                if k == "summary":
+                    task["description"] = v
+                elif k == "start":
+                    task["start"] = now if v else None
+                elif k in ("project", "priority", "status"):
+                    task[k] = v or None
+
+            action = batch.actions.get(task_id)
+            if action == "start":
+                task["start"] = now
+            elif action in ("stop", "done"):
+                task["start"] = None
+            if action == "done":
+                task["status"] = "completed"
+                task["end"] = now
+            task["modified"] = now
+
+            uuid = task["uuid"]
+            tasks.replace(task)
+            self.recent.update(task)
+            if self.projects is not None:
+                self.projects.update(task)
+            self.optimistic[uuid] = task
+            self.in_flight[uuid] = self.in_flight.get(uuid, 0) + 1
+            uuids.append(uuid)
+
+        if uuids:
+            urgency.update(tasks.tasks)
+            self.notify()
+        return uuids
+
+    def reconcile(self, uuids, error=None):
+        """Called when a write is done.  Reloads the database and reports
+        differences between what was expected and what TaskWarrior actually
+        wrote.  On errors the expected changes are dropped."""
+        if error is not None:
+            self.on_write_error(error)
+
+        expected = []
+        for uuid in uuids:
+            self.in_flight[uuid] -= 1
+            if not self.in_flight[uuid]:
+                del self.in_flight[uuid]
+                expected.append(self.optimistic.pop(uuid))
+
+        if not expected:
+            return  # more writes to these tasks are on the way
+
+        self._tasks = self.load_tasks()
+
+        if error is None:
+            for task in expected:
+                self.check_conflicts(task, self._tasks[task["uuid"]])
+
+        self.notify()
+
+    def check_conflicts(self, expected, actual):
+        if actual is None:
+            if expected.is_closed() and not self.has_closed():
+                return  # moved to completed.data, which is not loaded
+            util.log("Conflict: task {0} disappeared.", expected["uuid"])
+            return
+
+        for k in ("status", "description", "project", "priority"):
+            if expected[k] != actual[k]:
+                util.log("Conflict: task {0} has {1}={2!r}, expected {3!r}.",
+                         expected["uuid"], k, actual[k], expected[k])
+
+        if expected.is_active() != actual.is_active():
+            util.log("Conflict: task {0} is {1}active, expected otherwise.",
+                     expected["uuid"], "" if actual.is_active() else "not ")
+
+    def on_write_error(self, e):
+        util.log("Error updating tasks: {0}", e)
+        if self.on_error is not None:
+            self.on_error(e)
+
+    def get_queue_depth(self):
+        """Returns the number of writes which are not done yet."""
+        return len(self.queue)
+
+    def flush(self):
+        """Waits for pending writes to finish."""
+        self.queue.flush()
+
+    def batch(self):
+        """
+        Groups changes to tasks, which are applied in the background when
+        the block ends, with as few TaskWarrior invocations as possible:
+
+            with database.batch():
+                database.stop_task(a)
+                database.stop_task(b)
+
+        Nested blocks join the outer one.
+        """
+        return BatchContext(self)
 
     def start_task(self, task_id):
         util.log("Starting task {0}.", task_id)
-        util.run_command(["task", task_id, "start"])
+        with self.batch() as batch:
+            batch.start(task_id)
 
     def stop_task(self, task_id):
         util.log("Stopping task {0}.", task_id)
-        util.run_command(["task", task_id, "stop"], fail=False)
+        with self.batch() as batch:
+            batch.stop(task_id)
 
     def finish_task(self, task_id):
         util.log("Finishing task {0}.", task_id)
-        util.run_command(["task", task_id, "stop"], fail=False)
-        util.run_command(["task", task_id, "done"])
+        with self.batch() as batch:
+            batch.done(task_id)
 
     def restart_task(self, task_id):
         util.log("Restarting task {0}.", task_id)
-        util.run_command(["task", task_id, "mod", "status:pending"])
-        util.run_command(["task", task_id, "start"])
+        with self.batch() as batch:
+            batch.modify(task_id, {"status": "pending", "start": "now"})
 
     def update_task(self, task_id, properties):
-        command = ["task", task_id, "mod"]
-
+        modifications = {}
         for k, v in properties.items():
             if k == "uuid":
                 continue
-            if k == "tags":
-                for tag in v:
-                    if tag.strip():
-                        command.append(tag)
             elif k == "description":
-                command.append(v)
-            elif k == "note":
                 save_note(task_id, v)
             else:
-                command.append("{0}:{1}".format(k, v))
+                modifications[k] = v
 
-            util.run_command(command)
+        with self.batch() as batch:
+            batch.modify(task_id, modifications)
 
     def add_task(self, properties):
-        command = ["task", "add"]
-
-        for k, v in properties.items():
-            if k == "summary":
-                command.append(v)
-            elif k in ("project", "priority"):
-                command.append("%s:%s" % (k, v))
+        """Adds a task in the background.  The note is saved when the new
+        task's uuid is known."""
+        note = properties.get("description", "")
+
+        def on_added(uuid):
+            if uuid:
+                save_note(uuid, note)
+
+        self.queue.submit(self._add_task, (properties, ), on_added,
+                          self.on_write_error)
+
+    def _add_task(self, properties):
+        """Adds a task, returns its uuid.  Asks TaskWarrior to report the
+        new uuid, older versions which only report the id need another
+        command to find it."""
+        command = ["task", "rc.verbose=new-uuid", "add"]
+        command += Batch.get_arguments(dict((k, v)
+            for k, v in properties.items()
+            if k in ("summary", "project", "priority")))
 
         output = util.run_command(command)
 
-        for _taskno in re.findall("Created task (\d+)", output):
-            uuid = util.run_command(["task", _taskno, "uuid"]).strip()
+        uuids = re.findall("Created task ([0-9a-f-]{36})", output)
+        if not uuids:
+            for _taskno in re.findall("Created task (\d+)", output):
+                uuids.append(util.run_command(["task", _taskno,
+                                               "uuid"]).strip())
+
+        for uuid in uuids:
             util.log("New task uuid: {0}", uuid)
-            save_note(uuid, properties.get("description", ""))
             return uuid
-
-    def update_task(self, task_id, properties):
-        command = ["task", task_id, "mod"]
-
-        for k, v in properties.items():
-            if k in ("project", "priority"):
-                command.append("%s:%s" % (k, v))
-            elif k == "summary":
-                command.append(v)
-            elif k == "description":
-                save_note(task_id, v)
-
-        util.run_command(command)
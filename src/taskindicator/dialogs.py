@@ -2,21 +2,71 @@
 
 from __future__ import print_function
 
+import gobject
 import gtk
+import heapq
 import time
 import webbrowser
 
+from taskindicator import models
+from taskindicator import query
+from taskindicator import search
 from taskindicator import util
 from taskindicator.controls import *
 
 
+# Filtering starts when there are no keystrokes for FILTER_DELAY, and is
+# done in slices of about FILTER_BUDGET, so that typing is not blocked.
+FILTER_DELAY = 100  # milliseconds
+FILTER_BUDGET = 0.016  # seconds
+
+# Best fuzzy matches shown in the search dialog.
+FUZZY_LIMIT = 200
+
+
+# Sort keys for the search dialog.  Closed tasks are always last, active
+# tasks first, so open tasks are at the start of the list.  Urgency is
+# rounded as displayed, it changes with age all the time.
+
+def by_urgency(task):
+    return (task.is_closed(), not task.is_active(),
+            -round(float(task["urgency"]), 1))
+
+
+def by_modified(task):
+    return (task.is_closed(), not task.is_active(),
+            -(task["modified"] or 0))
+
+
+def by_project(task):
+    return (task.is_closed(), not task.is_active(),
+            (task.get_project() or u"").lower(),
+            -round(float(task["urgency"]), 1))
+
+
+SORT_ORDERS = (
+    ("urgency", by_urgency),
+    ("last modified", by_modified),
+    ("project", by_project),
+)
+
+
 class Search(gtk.Window):
     def __init__(self, database, parent=None):
         super(Search, self).__init__()
 
         self.database = database
         self.query = None
+        self.compiled = None  # see query.py
+        self.matches = None  # ids of tasks which match the query
+        self.filter_source = None
+        self.filter_steps = None  # see filter_step
+        self.filter_stats = None
+        self.ranked = False  # the model shows fuzzy matches, by score
+        self.index = search.TextIndex(self.get_search_text)
+        self.order = search.SortedIndex(SORT_ORDERS[0][1])
         self.tasks = None
+        self.stale = True  # tasks changed while hidden, see refresh
         self.selected_task_id = None
         self.selected_task = None
 
@@ -25,6 +75,8 @@ class Search(gtk.Window):
         self._setup_popup_menu()
         self.setup_signals()
 
+        self.database.index_notes(self._on_notes_indexed)
+
     def setup_window(self):
         # self.set_title("Task search")
         self.set_border_width(4)
@@ -56,31 +108,20 @@ class Search(gtk.Window):
             self.pmenu.popup(None, None, None, event.button, event.time)
 
     def _on_task_start(self, item):
-        self.set_task_active(True)
         self.database.start_task(self.selected_task_id)
 
     def _on_task_stop(self, item):
-        self.set_task_active(False)
         self.database.stop_task(self.selected_task_id)
 
     def _on_task_edit(self, item):
         self.on_activate_task(self.selected_task_id)
 
     def _on_task_done(self, item):
-        self.set_task_active(False, "completed")
         self.database.finish_task(self.selected_task_id)
 
     def _on_task_restart(self, item):
-        self.set_task_active(True)
         self.database.restart_task(self.selected_task_id)
 
-    def set_task_active(self, active, status=None):
-        for row in self.model:
-            if row[0] == self.selected_task_id:
-                row[6] = active
-                if status is not None:
-                    row[1] = status
-
     def _on_task_links(self, item):
         if self.selected_task:
             for part in self.selected_task["description"].split():
@@ -96,22 +137,9 @@ class Search(gtk.Window):
         self.vbox.pack_start(self.query_ctl, expand=False,
             fill=True, padding=4)
 
-        self.model = model = gtk.ListStore(
-            str,   # 0 id
-            str,   # 1 status
-            str,   # 2 project
-            str,   # 3 clean description
-            str,   # 4 urgency
-            str,   # 5 priority
-            bool,  # 6 started?
-            str,   # 7 raw_description
-            )
-
-        self.model_filter = model_filter = model.filter_new()
-        model_filter.set_visible_func(self.filter_tasks)
+        self.model = models.TaskListModel(self.get_row, self.is_visible)
 
         view = gtk.TreeView()
-        view.set_model(model_filter)
         view.connect("row_activated", self._on_row_activated)
         view.connect("cursor-changed", self._on_row_changed)
         self.tv = view
@@ -125,15 +153,23 @@ class Search(gtk.Window):
         rcell = gtk.CellRendererText()
         rcell.set_property("xalign", 1.0)
 
-        def add_column(text, cell, data_idx):
+        def add_column(text, cell, data_idx, width):
             col = gtk.TreeViewColumn(text, cell, text=data_idx)
             col.set_cell_data_func(cell, self.cell_data)
             # col.set_sort_column_id(data_idx)
+            col.set_sizing(gtk.TREE_VIEW_COLUMN_FIXED)
+            col.set_fixed_width(width)
+            col.set_resizable(True)
             view.append_column(col)
+            return col
 
-        add_column("Project", lcell, 2)
-        add_column("Pri", mcell, 5)
-        add_column("Description", lcell, 3)
+        add_column("Project", lcell, 2, 120)
+        add_column("Pri", mcell, 5, 40)
+        add_column("Description", lcell, 3, 400).set_expand(True)
+
+        # Only rows which are scrolled into view are read from the model.
+        view.set_fixed_height_mode(True)
+        self.set_model()
 
         scroll = gtk.ScrolledWindow()
         scroll.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_ALWAYS)
@@ -150,7 +186,17 @@ class Search(gtk.Window):
         self.vbox.pack_start(hbox, expand=False, fill=True)
 
         self.show_all_button = gtk.CheckButton("Show completed")
-        hbox.pack_start(self.show_all_button, expand=True, fill=True)
+        hbox.pack_start(self.show_all_button, expand=False, fill=False)
+
+        self.fuzzy_button = gtk.CheckButton("Fuzzy")
+        hbox.pack_start(self.fuzzy_button, expand=True, fill=True)
+
+        hbox.pack_start(gtk.Label("Sort by"), expand=False, fill=False)
+        self.sort_ctl = gtk.combo_box_new_text()
+        for label, key in SORT_ORDERS:
+            self.sort_ctl.append_text(label)
+        self.sort_ctl.set_active(0)
+        hbox.pack_start(self.sort_ctl, expand=False, fill=False)
 
         self.close_button = gtk.Button("Close")
         hbox.pack_end(self.close_button, expand=False, fill=False)
@@ -162,35 +208,207 @@ class Search(gtk.Window):
         self.add_button.connect("clicked", self._on_add_clicked)
         self.close_button.connect("clicked", self._on_close)
         self.show_all_button.connect("clicked", self._on_show_all)
+        self.sort_ctl.connect("changed", self._on_sort_changed)
+        self.fuzzy_button.connect("toggled", self._on_fuzzy_toggled)
         self.tv.connect("event", self._on_popup_menu)
         self.connect("delete_event", self._on_delete)
         self.connect("key-press-event", self._on_keypress)
 
-    def filter_tasks(self, model, iter):
-        if self.query is None:
-            return True
+    def set_model(self):
+        """Gives the model to the view, after it was reset.  Keeps the
+        selected task selected."""
+        self.model_filter = self.model.filter_new()
+        self.model_filter.set_visible_column(models.VISIBLE)
+        self.tv.set_model(self.model_filter)
+
+        n = self.model.get_position(self.selected_task_id)
+        if n is not None:
+            path = self.model_filter.convert_child_path_to_path((n, ))
+            if path is not None:
+                self.tv.get_selection().select_path(path)
 
+    def is_visible(self, task_id, task):
         # always show running tasks
-        running = model[iter][6]
-        if running:
+        if self.ranked or self.compiled is None or task.is_started():
+            return True
+        if self.matches is not None and task_id not in self.matches:
+            return False
+        return self.compiled(task)
+
+    def start_filter(self, delay=0):
+        """Updates row visibility, after a delay if given.  Cancels the
+        filtering which is in progress."""
+        if self.filter_source is not None:
+            gobject.source_remove(self.filter_source)
+            self.filter_source = None
+        self.filter_steps = None
+
+        if delay:
+            self.filter_source = gobject.timeout_add(delay,
+                                                     self._on_filter_timer)
+        else:
+            if self.is_fuzzy():
+                self.filter_steps = self.fuzzy_rows()
+            else:
+                self.filter_steps = self.filter_rows()
+            self.filter_stats = [time.time(), 0, 0, 0.0]
+            self.filter_source = gobject.idle_add(self.filter_step)
+
+    def _on_filter_timer(self):
+        self.start_filter()
+        return False
+
+    def filter_step(self):
+        """Runs filtering steps (see filter_rows and fuzzy_rows) for
+        FILTER_BUDGET, continues when idle.  Logs timing when done."""
+        started = time.time()
+        count = 0
+        for rows in self.filter_steps:
+            count += rows
+            if time.time() - started > FILTER_BUDGET:
+                return self.end_slice(started, count, True)
+
+        self.filter_steps = None
+        return self.end_slice(started, count, False)
+
+    def filter_rows(self):
+        """Updates row visibility.  Rows are checked in the display order,
+        so the first results are shown first.  Yields the number of rows
+        checked after every step, which takes a few milliseconds at most,
+        see filter_step."""
+        for _ in self.find_tasks():
+            yield 0
+
+        if self.ranked:
+            # Back from fuzzy matches, all tasks are shown again.
+            tasks = []
+            for _ in self.order.ordered_steps(tasks, self.get_task_count()):
+                yield 0
+            for _ in self.model.reset_steps(tasks):
+                yield 0
+            self.ranked = False
+            self.set_model()
+            yield 0
+
+        model = self.model
+        count = 0
+        for n in xrange(len(model)):
+            model.set_visible(n, self.is_visible(model.ids[n],
+                                                 model.tasks[n]))
+            count += 1
+            if count == 50:
+                yield count
+                count = 0
+        yield count
+
+    def is_fuzzy(self):
+        """Returns True if the query is matched fuzzily."""
+        return self.fuzzy_button.get_active() and self.compiled is not None \
+            and bool(self.compiled.words)
+
+    def fuzzy_rows(self):
+        """Scores tasks against the query words, then shows the best
+        FUZZY_LIMIT matches, by score.  Tasks must match the query filters,
+        words are matched fuzzily.  Yields like filter_rows."""
+        q = self.compiled
+
+        excluded = set()
+        for word in q.excluded:
+            for _ in self.index.find_steps(word, excluded):
+                yield 0
+
+        tasks = []
+        for _ in self.order.ordered_steps(tasks, self.get_task_count()):
+            yield 0
+
+        mask = search.char_mask(u"".join(q.words))
+        found = []
+        count = 0
+        for n, task in enumerate(tasks):
+            task_id = str(task.id())
+            if task_id not in excluded and q(task):
+                score = self.index.fuzzy(q.words, task_id, mask)
+                if score is not None:
+                    # Ties are kept in the sort order.
+                    found.append((score, -n, task))
+            count += 1
+            if count == 50:
+                yield count
+                count = 0
+        yield count
+
+        best = [task for score, n, task in
+                heapq.nlargest(FUZZY_LIMIT, found)]
+        util.log("Found {0} fuzzy matches.", len(found))
+        yield 0
+
+        if self.ranked:
+            self.show_tasks(best)
+        else:
+            # All tasks are replaced, which is quicker than removing them.
+            self.ranked = True
+            self.model.reset(best)
+            self.set_model()
+        for n in xrange(len(self.model)):
+            self.model.set_visible(n, True)
+        yield 0
+
+    def end_slice(self, started, count, more):
+        """Counts a filtering slice, logs timing when done.  Returns more,
+        to keep the idle callback."""
+        duration = time.time() - started
+        stats = self.filter_stats
+        stats[1] += count
+        stats[2] += 1
+        stats[3] = max(stats[3], duration)
+
+        if more:
             return True
 
-        parts = []
-        for field in (0, 2, 7):
-            raw = model.get_value(iter, field)
-            if raw:
-                txt = unicode(raw, "utf-8")
-                parts.append(txt.lower())
-        fulltext = u" ".join(parts)
-
-        for word in self.query.lower().split():
-            if word.startswith("-"):
-                if word[1:] in fulltext:
-                    return False
-            elif word not in fulltext:
-                return False
-
-        return True
+        self.filter_source = None
+        util.log("Filtered {0} rows in {1} slices, {2:.1f} ms, longest slice"
+                 " {3:.1f} ms.", stats[1], stats[2],
+                 (time.time() - stats[0]) * 1000, stats[3] * 1000)
+        if stats[3] > FILTER_BUDGET * 2:
+            util.log("Filtering is too slow, the UI is not responsive.")
+        return False
+
+    def get_search_text(self, task):
+        """Returns the text which queries are matched against, besides the
+        task id."""
+        parts = [task.get_project() or u"", task.get_summary() or u""]
+        return u" ".join(p if isinstance(p, unicode)
+                         else p.decode("utf-8") for p in parts)
+
+    def find_tasks(self):
+        """Finds ids of tasks which match the words of the query, using the
+        indexes, sets self.matches.  Filters are checked by is_visible.
+        Yields between steps, see filter_rows."""
+        q = self.compiled
+        if q is None or not (q.words or q.excluded):
+            self.matches = None
+            return
+
+        matches = None
+        excluded = set()
+        for word in q.excluded:
+            for _ in self.index.find_steps(word, excluded):
+                yield
+
+        for word in q.words:
+            found = set()
+            for _ in self.index.find_steps(word, found):
+                yield
+            found |= self.database.search_notes(word)
+            if matches is None:
+                matches = found
+            else:
+                matches &= found
+            yield
+
+        if matches is None:
+            matches = set(self.index.texts)
+        self.matches = matches - excluded
 
     def cell_data(self, col, cell, model, iter, data=None):
         status = model[iter][1]
@@ -208,45 +426,64 @@ class Search(gtk.Window):
     def refresh(self):
         """
         Updates the task list with the new tasks.  Also reloads the full task
-        list, to show when the corresponding checkbox is checked.
+        list, to show when the corresponding checkbox is checked.  Closed
+        tasks are only loaded from the database when it's checked.
+
+        Tasks are indexed at start.  After that, while the dialog is
+        hidden, it's only marked as stale, and updated when shown.
         """
-        tasks = self.database.get_tasks()
+        if self.tasks is not None and not self.get_property("visible"):
+            self.stale = True
+            return
+        self.stale = False
+
+        closed = self.show_all_button.get_active()
+        tasks = self.database.get_tasks(closed=closed)
         self.tasks = [t for t in tasks if not t.is_closed()]
         self.all_tasks = [t for t in tasks if not t.is_deleted()]
+        self.index.sync(self.all_tasks)
+        self.order.sync(self.all_tasks)
         self.refresh_table()
 
     def refresh_table(self):
-        if self.show_all_button.get_active():
-            tasks = self.all_tasks
-        else:
-            tasks = self.tasks
-
-        self.model.clear()
-        for task in sorted(tasks, key=self.task_sort_func):
-            row = [task.id(),
-                  task["status"],
-                  task.get_project(),
-                  util.strip_description(task.get_summary()),
-                  "%.1f" % float(task["urgency"]),
-                  task.get("priority", "L"),
-                  task.is_started(),
-                  task.get_summary()]
-            self.model.append(row)
+        tasks = self.get_sorted_tasks()
+        if not self.is_fuzzy():
+            self.ranked = False
+            self.show_tasks(tasks)
+        self.start_filter()
 
         title = "Search for tasks (%u)" % len(tasks)
         self.set_title(title)
 
-    def task_sort_func(self, task):
-        # active tasksk are always first
-        active = -task.is_active()
-
-        # completed tasks are always last
-        completed = task.is_closed()
+    def get_sorted_tasks(self):
+        return self.order.ordered(self.get_task_count())
 
-        return (active, completed, -float(task["urgency"]))
+    def get_task_count(self):
+        """Returns the number of tasks to show.  Open tasks are sorted
+        first (see SORT_ORDERS), closed ones are only shown if asked for."""
+        if self.show_all_button.get_active():
+            return None
+        return len(self.tasks)
+
+    def show_tasks(self, tasks):
+        if not self.model.update(tasks):
+            self.set_model()
+
+    def get_row(self, task):
+        """Returns model values for the task, see models.COLUMNS."""
+        return (str(task.id()),
+                task["status"],
+                task.get_project(),
+                util.strip_description(task.get_summary()),
+                "%.1f" % float(task["urgency"]),
+                task.get("priority", "L"),
+                task.is_started(),
+                task.get_summary())
 
     def show_all(self):
         super(Search, self).show_all()
+        if self.stale:
+            self.refresh()
         self.present()
         self.pmenu.show_all()
 
@@ -315,9 +552,23 @@ class Search(gtk.Window):
 
     def _on_query_changed(self, ctl):
         """Handles the query change.  Stores the new query in self.query for
-        quicker access, then refilters the tree."""
+        quicker access, then refilters the tree when typing stops."""
         self.query = unicode(ctl.get_text(), "utf-8").lower()
-        self.model_filter.refilter()
+        self.compiled = None
+        if self.query.strip():
+            self.compiled = query.compile(self.query)
+
+            # Closed tasks are only loaded when shown.
+            if self.compiled.closed and \
+                    not self.show_all_button.get_active():
+                self.show_all_button.set_active(True)
+
+        self.start_filter(FILTER_DELAY)
+
+    def _on_notes_indexed(self):
+        if self.query:
+            self.start_filter()
+        return False
 
     def _on_close(self, widget):
         self.hide()
@@ -326,7 +577,19 @@ class Search(gtk.Window):
         self.on_activate_task(None)
 
     def _on_show_all(self, widget):
-        self.refresh_table()
+        if widget.get_active():
+            self.refresh()
+        else:
+            self.refresh_table()
+
+    def _on_sort_changed(self, widget):
+        self.order.set_key(SORT_ORDERS[widget.get_active()][1])
+        if self.tasks is not None:
+            self.refresh_table()
+
+    def _on_fuzzy_toggled(self, widget):
+        if self.tasks is not None:
+            self.start_filter()
 
     def _on_keypress(self, widget, event):
         if event.keyval == gtk.keysyms.Escape:
@@ -463,6 +726,7 @@ class Properties(gtk.Window):
 
         self.database = database
         self.task = None
+        self.note_loaded = False
 
         self.set_border_width(10)
 
@@ -572,7 +836,10 @@ class Properties(gtk.Window):
         self.description.set_text(task.get_summary())
         self.project.set_text(task["project"] or "")
         self.priority.set_text(str(task["priority"]))
-        self.notes.set_text(task.get_description() or "")
+
+        # The note is loaded after the dialog is shown.
+        self.notes.set_sensitive(False)
+        gobject.idle_add(self.load_note)
 
         self.completed.set_active(task["status"] == "completed")
 
@@ -581,21 +848,36 @@ class Properties(gtk.Window):
         else:
             self.start.set_label("Start")
 
+    def load_note(self):
+        self.notes.set_text(self.task.get_description() or "")
+        self.notes.set_sensitive(True)
+        self.note_loaded = True
+        return False
+
     def _on_browse(self, widget):
         for word in self.task.get_summary().split(" "):
             if "://" in word:
                 webbrowser.open(word)
 
     def on_close(self, widget):
-        self.database.update_task(self.task.id(), {
+        properties = {
             "summary": self.description.get_text(),
             "project": self.project.get_text(),
             "priority": self.priority.get_text(),
-            "description": self.notes.get_text(),
-        })
+        }
+
+        # Closed before the note was loaded.
+        if self.note_loaded:
+            properties["description"] = self.notes.get_text()
+
+        with self.database.batch():
+            self.database.update_task(self.task.id(), properties)
 
-        if self.completed.get_active():
-            self.database.finish_task(self.task.id())
+            # TaskWarrior refuses to finish a completed task again, and
+            # would drop the modifications too.
+            if self.completed.get_active() \
+                    and self.task["status"] != "completed":
+                self.database.finish_task(self.task.id())
 
         self.destroy()
 
@@ -606,8 +888,7 @@ class Properties(gtk.Window):
     def on_start_stop(self, widget):
         if self.task.is_active():
             self.database.stop_task(self.task.id())
-            self.task.set_active(False)
         else:
             self.database.start_task(self.task.id())
-            self.task.set_active(True)
+        self.task = self.database.get_task_info(self.task.id()) or self.task
         self.set_start_stop_label()
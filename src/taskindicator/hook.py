@@ -0,0 +1,146 @@
+# encoding=utf-8
+
+"""
+TaskWarrior hooks.
+
+The on-add and on-modify hooks, installed with "task-indicator
+--install-hooks", send every changed task to the running indicator over a
+Unix socket, so that changes made with the command line, bugwarrior etc.
+are applied one task at a time, without reading the database (see
+Database.apply_delta).  The hook scripts don't import this package, so
+that they add as little as possible to each TaskWarrior command.
+"""
+
+import errno
+import json
+import os
+import socket
+import sys
+
+import gobject
+
+from taskindicator import cache
+from taskindicator import taskrc
+from taskindicator import util
+
+
+HOOKS = ("on-add", "on-modify")
+
+# The name hook scripts are installed as, e.g. on-add-task-indicator.
+SUFFIX = "-task-indicator"
+
+# The hook gets the original and the changed task on separate lines (only
+# the new one for on-add), and must print the changed task back.  If it
+# fails, TaskWarrior rejects the command, so all errors are ignored (the
+# indicator is not always running).  It runs with the interpreter which
+# installed it, but works with Python 3 too.
+SCRIPT = """#!%(python)s
+# Installed by task-indicator, sends changed tasks to it.
+
+import socket
+import sys
+
+# Bytes on Python 3 too, whatever the locale.
+stdin = getattr(sys.stdin, "buffer", sys.stdin)
+stdout = getattr(sys.stdout, "buffer", sys.stdout)
+
+lines = stdin.readlines()
+if lines:
+    stdout.write(lines[-1])
+    stdout.flush()
+    try:
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        s.sendto(lines[-1], %(path)r)
+    except Exception:
+        pass
+"""
+
+MAX_SIZE = 1 << 20
+
+
+def get_socket_path():
+    base = os.getenv("XDG_RUNTIME_DIR") or cache.get_folder()
+    return os.path.join(base, "task-indicator.sock")
+
+
+def get_hooks_folder():
+    location = taskrc.get_config().get("hooks.location")
+    return os.path.expanduser(location or "~/.task/hooks")
+
+
+def install():
+    """Writes the hook scripts to the TaskWarrior hooks folder."""
+    folder = get_hooks_folder()
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    script = SCRIPT % {"python": sys.executable or "/usr/bin/env python",
+                       "path": get_socket_path()}
+    for name in HOOKS:
+        path = os.path.join(folder, name + SUFFIX)
+        with open(path, "wb") as f:
+            f.write(script)
+        os.chmod(path, 0755)
+        util.log("Installed hook {0}", path)
+
+
+class HookListener(object):
+    """Receives tasks sent by the hook scripts, calls back in the main loop
+    with the task data."""
+
+    def __init__(self, callback, path=None):
+        self.callback = callback
+        self.path = path or get_socket_path()
+
+        folder = os.path.dirname(self.path)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        # Left by an instance which crashed.
+        try:
+            os.unlink(self.path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        self.sock.setblocking(False)
+        os.chmod(self.path, 0600)
+
+        gobject.io_add_watch(self.sock.fileno(), gobject.IO_IN,
+                             self._on_data)
+
+    def close(self):
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def _on_data(self, fd, condition):
+        while True:
+            try:
+                data = self.sock.recv(MAX_SIZE)
+            except socket.error, e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    util.log("Error reading from hook socket: {0}", e)
+                return True
+
+            try:
+                task = json.loads(data)
+            except ValueError, e:
+                util.log("Bad task from hook: {0}", e)
+                continue
+
+            if isinstance(task, dict) and task.get("uuid"):
+                self.callback(task)
+
+
+def create(callback):
+    """Returns a listener, or None if the socket can't be used."""
+    try:
+        return HookListener(callback)
+    except (EnvironmentError, socket.error), e:
+        util.log("Can't listen for hooks: {0}", e)
+        return None
@@ -9,8 +9,6 @@ __author__ = "Justin Forest"
 __email__ = "hex@umonkey.net"
 
 
-import datetime
-import dateutil.parser
 import json
 import os
 import re
@@ -19,6 +17,7 @@ import subprocess
 import sys
 import time
 
+import gobject
 import pygtk
 pygtk.require("2.0")
 import gtk
@@ -31,11 +30,24 @@ except ImportError:
 
 from taskindicator import database
 from taskindicator import dialogs
+from taskindicator import hook
+from taskindicator import taskrc
 from taskindicator import util
+from taskindicator import watcher
 from taskindicator.pull import ProcessRunner
 
 
 FREQUENCY = 1  # seconds
+CACHE_DELAY = 10  # seconds, see Checker.schedule_cache_save
+
+# While hooks report changes, database reloads are delayed (see
+# Checker.on_database_changed).
+HOOK_TIMEOUT = 5  # seconds
+RELOAD_DELAY = 30  # seconds
+
+# Recently modified tasks in the menu, and in each project submenu.  Can be
+# changed with indicator.menu.size in .taskrc.
+MENU_SIZE = 10
 
 
 def get_program_path(command):
@@ -45,6 +57,24 @@ def get_program_path(command):
             return full
 
 
+def get_menu_size():
+    value = taskrc.get_config().get("indicator.menu.size")
+    if not value:
+        return MENU_SIZE
+    try:
+        return max(0, int(value))
+    except ValueError:
+        util.log("Bad indicator.menu.size: {0}", value)
+        return MENU_SIZE
+
+
+def use_project_menus():
+    """Returns True if the menu has a submenu for each project, set with
+    indicator.menu.projects=yes in .taskrc."""
+    value = taskrc.get_config().get("indicator.menu.projects") or "no"
+    return value.lower() in ("yes", "y", "on", "true", "1")
+
+
 class BaseIndicator(object):
     # http://www.pygtk.org/pygtk2reference/gtk-stock-items.html
     ACTIVE_ICON = gtk.STOCK_MEDIA_PLAY
@@ -52,6 +82,13 @@ class BaseIndicator(object):
     def __init__(self):
         self.stop_item = None
         self.task_items = []
+        self.menu_size = get_menu_size()
+
+        # Project submenus are filled when opened, see on_project_menu.
+        self.project_menus = use_project_menus()
+        self.project_items = []  # (project, menu item)
+        self.project_index = None
+        self.filled = set()  # projects whose submenus are up to date
 
         self.setup_menu()
         self.setup_icon()
@@ -77,13 +114,8 @@ class BaseIndicator(object):
             return item
 
         self.task_items = []
-        for x in range(10):
-            item = gtk.ImageMenuItem()
-            item.set_label("task placeholder")
-            item.connect("activate",
-                         lambda item: self.on_task_selected(item.get_data("task")))
-            self.menu.append(item)
-            self.task_items.append(item)
+        for x in range(self.menu_size):
+            self.task_items.append(self.add_task_item(self.menu))
 
         self.separator = gtk.SeparatorMenuItem()
         self.menu.append(self.separator)
@@ -105,6 +137,17 @@ class BaseIndicator(object):
             lambda *args: self.on_quit(),
             gtk.STOCK_QUIT)
 
+    def add_task_item(self, menu):
+        """Adds a task placeholder to the menu, see update_task_item."""
+        item = gtk.ImageMenuItem()
+        item.set_label("task placeholder")
+        item.set_data("icon", gtk.image_new_from_stock(
+            self.ACTIVE_ICON, gtk.ICON_SIZE_MENU))
+        item.connect("activate",
+                     lambda item: self.on_task_selected(item.get_data("task")))
+        menu.append(item)
+        return item
+
     def setup_icon(self):
         util.log("WARNING: setup_icon not implimented")
 
@@ -113,34 +156,101 @@ class BaseIndicator(object):
         Update tasks in the tray menu
 
         Updates placeholder menu items with real data, proper icons and
-        visibility.
+        visibility.  Items which show the same task, in the same state, are
+        left alone.
         """
         for idx, item in enumerate(self.task_items):
             if idx >= len(tasks):
+                item.set_data("key", None)
                 item.hide()
             else:
-                task = tasks[idx]
-                desc = util.strip_description(task.get_summary())
+                self.update_task_item(item, tasks[idx])
 
-                if task.is_active():
-                    label = item.get_children()[0]
-                    label.set_markup("<b>%s</b>" % desc)
+        self.update_separator()
 
-                    icon = gtk.image_new_from_stock(self.ACTIVE_ICON,
-                                                    gtk.ICON_SIZE_MENU)
-                    item.set_image(icon)
-                else:
-                    item.set_label(desc)
-                    item.set_image(None)
+    def update_task_item(self, item, task):
+        """Shows the task in a menu item, unless it already shows the same
+        task in the same state."""
+        item.set_data("task", task)
 
-                item.set_data("task", task)
-                item.show()
+        key = (task.id(), task.get_summary(), task.is_active())
+        if item.get_data("key") == key:
+            return
+        item.set_data("key", key)
+
+        desc = util.strip_description(task.get_summary())
+        if task.is_active():
+            label = item.get_children()[0]
+            label.set_markup("<b>%s</b>" % desc)
+            item.set_image(item.get_data("icon"))
+        else:
+            item.set_label(desc)
+            item.set_image(None)
+        item.show()
 
-        if tasks:
+    def update_separator(self):
+        shown = [item for item in self.task_items if item.get_data("key")]
+        if shown or self.project_items:
             self.separator.show()
         else:
             self.separator.hide()
 
+    def set_projects(self, index):
+        """
+        Update project submenus
+
+        Adds a submenu for each project with open tasks (see
+        recent.ProjectIndex).  Tasks are only added to a submenu when it's
+        opened, so refreshing doesn't depend on the number of tasks.
+        """
+        self.project_index = index
+        self.filled.clear()
+
+        names = index.names()
+        if names != [name for name, item in self.project_items]:
+            for name, item in self.project_items:
+                self.menu.remove(item)
+
+            self.project_items = []
+            position = len(self.task_items)
+            for name in names:
+                item = gtk.MenuItem()
+                item.set_submenu(gtk.Menu())
+                # Not the submenu's "show": with AppIndicator the menu is
+                # exported over D-Bus and never shown, opening a submenu
+                # activates its item.
+                item.connect("activate", self.on_project_menu, name)
+                item.show()
+                self.menu.insert(item, position)
+                self.project_items.append((name, item))
+                position += 1
+
+        for name, item in self.project_items:
+            label = u"%s (%u)" % (name, index.count(name))
+            if item.get_label() != label:
+                item.set_label(label)
+
+        self.update_separator()
+
+    def on_project_menu(self, project_item, project):
+        """Fills a project submenu with its most urgent tasks when it's
+        opened, if they changed since the last time."""
+        if project in self.filled or self.project_index is None:
+            return
+        self.filled.add(project)
+
+        menu = project_item.get_submenu()
+        tasks = self.project_index.get(project, self.menu_size)
+        items = menu.get_children()
+        for item in items[len(tasks):]:
+            menu.remove(item)
+        for idx, task in enumerate(tasks):
+            if idx < len(items):
+                item = items[idx]
+            else:
+                item = self.add_task_item(menu)
+            self.update_task_item(item, task)
+
     def can_pull(self):
         return get_program_path("task-pull") != None
 
@@ -253,12 +363,19 @@ class Checker(object):
 
     def __init__(self):
         self.toggle_lock = False
-        self.started_ts = []
+        self.started_at = []
+        self.status_timer = None
+        self.cache_timer = None
 
         self.setup_indicator()
 
         self.database = database.Database()
-        self.database_ts = 0
+        self.database.on_error = self.on_database_error
+        self.database.add_listener(self.on_tasks_changed)
+        self.watcher = None
+        self.hooks = None
+        self.hook_seen = 0
+        self.reload_timer = None
 
         self.search_dialog = dialogs.Search(self.database)
 
@@ -278,14 +395,10 @@ class Checker(object):
         self.indicator.on_task_selected = self.on_task_selected
 
     def menu_add_tasks(self):
-        tasks = filter(lambda t: t["status"] == "pending",
-                       self.database.get_tasks())
-
-        tasks = sorted(tasks,
-                       key=lambda t: t["modified"],
-                       reverse=True)
-
+        tasks = self.database.get_recent_tasks(self.indicator.menu_size)
         self.indicator.set_tasks(tasks)
+        if self.indicator.project_menus:
+            self.indicator.set_projects(self.database.get_project_index())
 
     def on_add_task(self):
         dialogs.New.show_task(self.database)
@@ -306,7 +419,10 @@ class Checker(object):
 
     def main(self):
         """Enters the main program loop"""
-        self.on_timer()
+        self.on_tasks_changed()
+        self.watcher = watcher.create(self.database.get_watch_files(),
+                                      self.on_database_changed)
+        self.hooks = hook.create(self.on_hook)
 
         def handle(*args, **kwargs):
             util.log("Got signal USR1, showing the search dialog.")
@@ -319,33 +435,95 @@ class Checker(object):
         self.indicator.set_idle()
 
         def timer():
-            for task in self.database.get_tasks():
-                if "start" in task:
-                    self.database.stop_task(task.id())
+            with self.database.batch():
+                for task in self.database.get_tasks():
+                    if "start" in task:
+                        self.database.stop_task(task.id())
 
         gtk.idle_add(timer)
 
+    def on_database_error(self, e):
+        """Shows errors which happened while changing tasks in the
+        background."""
+        dlg = gtk.MessageDialog(type=gtk.MESSAGE_ERROR,
+                                buttons=gtk.BUTTONS_CLOSE,
+                                message_format="Could not update tasks: %s" % e)
+        dlg.set_title("TaskWarrior error")
+        dlg.connect("response", lambda dlg, response: dlg.destroy())
+        dlg.show()
+
     def on_quit(self):
         """Ends the applet"""
+        self.database.flush()
+        self.database.save_cache()
+        if self.hooks is not None:
+            self.hooks.close()
         sys.exit(0)
 
-    def on_timer(self):
-        """Timer handler which updates the list of tasks and the status."""
-        gtk.timeout_add(FREQUENCY * 1000, self.on_timer)
+    def on_database_changed(self):
+        """Reloads tasks when the database changes (see watcher.py).  The
+        database calls on_tasks_changed if anything was reloaded.
 
-        if self.database.modified_since(self.database_ts):
+        While hooks are reporting changes, they are already applied, so the
+        database is only reloaded a while later, in case something was
+        changed without hooks."""
+        if time.time() - self.hook_seen > HOOK_TIMEOUT:
             util.log("Task database changed.")
             self.database.refresh()
-            self.search_dialog.refresh()
-            self.menu_add_tasks()
-            self.database_ts = int(time.time())
+        elif self.reload_timer is None:
+            self.reload_timer = gtk.timeout_add(RELOAD_DELAY * 1000,
+                                                self.on_reload_timer)
+
+    def on_reload_timer(self):
+        self.reload_timer = None
+        self.database.refresh()
+        return False
+
+    def on_hook(self, data):
+        """Applies a task sent by a TaskWarrior hook (see hook.py)."""
+        if self.database.apply_delta(data):
+            self.hook_seen = time.time()
+
+    def on_tasks_changed(self):
+        """Updates the menu, status and search dialog.  Called when the
+        database is reloaded, and right after changes are made, before they
+        are written."""
+        self.search_dialog.refresh()
+        self.menu_add_tasks()
+
+        self.started_at = []
+        for task in self.database.get_tasks():
+            if task.is_active() and not task.is_closed():
+                self.started_at.append(task.get_start_ts())
+
+        self.update_status()
+        self.schedule_cache_save()
 
-            self.started_at = []
-            for task in self.database.get_tasks():
-                if task.is_active() and not task.is_closed():
-                    self.started_at.append(task.get_start_ts())
+        # Only wake up periodically while there are running tasks.
+        if self.started_at and self.status_timer is None:
+            self.status_timer = gtk.timeout_add(FREQUENCY * 1000,
+                                                self.on_timer)
 
+    def on_timer(self):
+        """Timer handler which updates the activity time.  Stops when there
+        are no running tasks."""
         self.update_status()
+        if not self.started_at:
+            self.status_timer = None
+            return False
+        return True
+
+    def schedule_cache_save(self):
+        """Saves parsed tasks for the next start, a little later, so that a
+        series of changes is saved once."""
+        if self.cache_timer is None:
+            self.cache_timer = gtk.timeout_add(CACHE_DELAY * 1000,
+                                               self.on_cache_timer)
+
+    def on_cache_timer(self):
+        self.cache_timer = None
+        self.database.save_cache()
+        return False
 
     def update_status(self):
         """
@@ -400,11 +578,18 @@ def show_existing_instance():
 
 
 def main():
+    if "--install-hooks" in sys.argv[1:]:
+        hook.install()
+        return
+
     if show_existing_instance():
         return
 
     os.chdir("/")
 
+    # Database changes are written in a separate thread.
+    gobject.threads_init()
+
     app = Checker()
     app.main()
     # app.search_dialog.show_all()
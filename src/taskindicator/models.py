@@ -0,0 +1,245 @@
+# encoding=utf-8
+
+"""
+Tree models.
+
+TaskListModel shows a list of tasks without copying them into a
+gtk.ListStore: cell values are computed when the view asks for them, and
+only kept for recently shown rows.  With a fixed height tree view only the
+visible rows are asked for, so a list of 100k tasks costs about as much as
+a screenful.
+"""
+
+import collections
+import itertools
+
+import gtk
+
+from taskindicator import util
+
+
+CACHE_SIZE = 500  # rows
+
+# Rows prepared at a time by reset_steps.
+STEP = 5000
+
+# Each removed or added row moves the rows after it, which are renumbered
+# when a view asks for one of them.  When changes could renumber more rows
+# than this, the model is reset instead, see TaskListModel.update.
+MAX_RENUMBERED = 1000000
+
+# Columns returned by the row function, plus the visibility flag.
+COLUMNS = (
+    str,   # 0 id
+    str,   # 1 status
+    str,   # 2 project
+    str,   # 3 clean description
+    str,   # 4 urgency
+    str,   # 5 priority
+    bool,  # 6 started?
+    str,   # 7 raw_description
+    bool,  # 8 visible, see set_visible
+)
+
+VISIBLE = 8
+
+
+class TaskListModel(gtk.GenericTreeModel):
+    """Rows are task ids, cell values come from get_row(task).  Rows for
+    which is_visible(task_id, task) is False are marked as hidden when
+    added; set_visible changes that later."""
+
+    def __init__(self, get_row, is_visible):
+        gtk.GenericTreeModel.__init__(self)
+        self.get_row = get_row
+        self.is_visible = is_visible
+        self.tasks = []
+        self.ids = []
+        self.positions = {}  # task id => row number, see get_position
+        self.dirty_from = None  # positions from this one may be wrong
+        self.hidden = set()
+        self.cache = collections.OrderedDict()  # task id => (task, row)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get_task(self, n):
+        return self.tasks[n]
+
+    def get_position(self, task_id):
+        """Returns the row number of a task, or None.  Rows after removed
+        or added ones are renumbered here, once for all changes."""
+        n = self.positions.get(task_id)
+        if n is not None and self.dirty_from is not None \
+                and n >= self.dirty_from:
+            for i in xrange(self.dirty_from, len(self.ids)):
+                self.positions[self.ids[i]] = i
+            self.dirty_from = None
+            n = self.positions[task_id]
+        return n
+
+    def get_cells(self, task_id):
+        task = self.tasks[self.get_position(task_id)]
+        cached = self.cache.pop(task_id, None)
+        if cached is None or cached[0] is not task:
+            cached = (task, self.get_row(task))
+        self.cache[task_id] = cached
+        if len(self.cache) > CACHE_SIZE:
+            self.cache.popitem(last=False)
+        return cached[1]
+
+    def reset(self, tasks):
+        """Replaces all rows without telling the views, the model must be
+        given to them again.  Rows stay hidden if they were."""
+        for _ in self.reset_steps(tasks):
+            pass
+
+    def reset_steps(self, tasks):
+        """Same as reset, but yields after every STEP rows, so that a long
+        list can be prepared a part at a time.  The rows are only replaced
+        after the last step."""
+        tasks = list(tasks)
+        ids = []
+        positions = {}
+        for start in xrange(0, len(tasks), STEP):
+            end = start + STEP
+            ids.extend(str(task.id()) for task in tasks[start:end])
+            positions.update(itertools.izip(ids[start:end],
+                                            itertools.count(start)))
+            yield
+
+        self.tasks = tasks
+        self.ids = ids
+        self.positions = positions
+        self.dirty_from = None
+        self.hidden = set(task_id for task_id in self.hidden
+                          if task_id in positions)
+        self.cache.clear()
+        self.invalidate_iters()
+
+    def update(self, tasks):
+        """Changes the rows to the tasks, in that order, telling the views
+        about each removed, moved, changed or added row.  Rows which are
+        not part of the longest correctly ordered sequence are moved.  If
+        that would renumber more than MAX_RENUMBERED rows, resets the model
+        and returns False."""
+        tasks = list(tasks)
+        ids = [str(task.id()) for task in tasks]
+        new_positions = dict((task_id, n) for n, task_id in enumerate(ids))
+
+        if ids == self.ids:
+            stay = new_positions  # nothing moved, which is the usual case
+        else:
+            kept = [task_id for task_id in self.ids
+                    if task_id in new_positions]
+            order = [new_positions[task_id] for task_id in kept]
+            stay = set(kept[n] for n in util.longest_increasing(order))
+
+        changes = len(self.ids) - len(stay) + len(ids) - len(stay)
+        if changes * max(len(self.ids), len(ids)) > MAX_RENUMBERED:
+            self.reset(tasks)
+            return False
+
+        for n in reversed(xrange(len(self.ids))):
+            if self.ids[n] not in stay:
+                self._remove(n)
+
+        for n, task_id in enumerate(self.ids):
+            task = tasks[new_positions[task_id]]
+            if task is not self.tasks[n]:
+                self.tasks[n] = task
+                self.row_changed((n, ), self.get_iter((n, )))
+
+        # Cached rows of tasks changed in place, i.e., urgency.
+        for task_id, (task, row) in self.cache.items():
+            n = self.get_position(task_id)
+            if n is not None and self.tasks[n] is task \
+                    and self.get_row(task) != row:
+                del self.cache[task_id]
+                self.row_changed((n, ), self.get_iter((n, )))
+
+        for n, task_id in enumerate(ids):
+            if task_id not in self.positions:
+                self._insert(n, tasks[n])
+
+        return True
+
+    def _remove(self, n):
+        task_id = self.ids.pop(n)
+        del self.tasks[n]
+        del self.positions[task_id]
+        self.cache.pop(task_id, None)
+        self.hidden.discard(task_id)
+        self.set_dirty(n)
+        self.row_deleted((n, ))
+
+    def _insert(self, n, task):
+        task_id = str(task.id())
+        self.ids.insert(n, task_id)
+        self.tasks.insert(n, task)
+        self.set_dirty(n)
+        self.positions[task_id] = n
+        if not self.is_visible(task_id, task):
+            self.hidden.add(task_id)
+        self.row_inserted((n, ), self.get_iter((n, )))
+
+    def set_dirty(self, n):
+        """Rows from n on have moved.  Their old positions are all n or
+        more, so positions below dirty_from stay right."""
+        if self.dirty_from is None or n < self.dirty_from:
+            self.dirty_from = n
+
+    def set_visible(self, n, visible):
+        """Shows or hides a row (see gtk.TreeModelFilter)."""
+        task_id = self.ids[n]
+        if visible == (task_id in self.hidden):
+            if visible:
+                self.hidden.discard(task_id)
+            else:
+                self.hidden.add(task_id)
+            self.row_changed((n, ), self.get_iter((n, )))
+
+    def on_get_flags(self):
+        return gtk.TREE_MODEL_LIST_ONLY | gtk.TREE_MODEL_ITERS_PERSIST
+
+    def on_get_n_columns(self):
+        return len(COLUMNS)
+
+    def on_get_column_type(self, n):
+        return COLUMNS[n]
+
+    def on_get_iter(self, path):
+        if path[0] < len(self.ids):
+            return self.ids[path[0]]
+
+    def on_get_path(self, rowref):
+        return (self.get_position(rowref), )
+
+    def on_get_value(self, rowref, column):
+        if column == VISIBLE:
+            return rowref not in self.hidden
+        return self.get_cells(rowref)[column]
+
+    def on_iter_next(self, rowref):
+        n = self.get_position(rowref) + 1
+        if n < len(self.ids):
+            return self.ids[n]
+
+    def on_iter_children(self, parent):
+        if parent is None and self.ids:
+            return self.ids[0]
+
+    def on_iter_has_child(self, rowref):
+        return False
+
+    def on_iter_n_children(self, rowref):
+        if rowref is None:
+            return len(self.ids)
+        return 0
+
+    def on_iter_nth_child(self, parent, n):
+        if parent is None and n < len(self.ids):
+            return self.ids[n]
+
+    def on_iter_parent(self, child):
+        return None
@@ -0,0 +1,174 @@
+# encoding=utf-8
+
+"""
+Task notes.
+
+Notes are kept in a single SQLite database next to the TaskWarrior data
+files, instead of one file per task.  The uuids of tasks which have notes
+are kept in memory, so that tasks without notes (most of them) never touch
+the database, recently used notes are cached.  Notes from the old
+~/.task/notes folder are moved to the database on first use.
+
+Notes are also indexed for searching, see search.TokenIndex.
+"""
+
+import collections
+import os
+import sqlite3
+import time
+
+from taskindicator import search
+from taskindicator import taskrc
+from taskindicator import util
+
+
+CACHE_SIZE = 100  # notes
+
+LEGACY_FOLDER = "~/.task/notes"
+
+DATABASE_INIT = """
+CREATE TABLE IF NOT EXISTS notes (
+    uuid TEXT PRIMARY KEY,
+    modified INTEGER,
+    body TEXT
+);
+"""
+
+
+class NoteStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(DATABASE_INIT)
+        self.conn.commit()
+
+        self.index = set(row[0] for row in
+                         self.conn.execute("SELECT uuid FROM notes"))
+        self.cache = collections.OrderedDict()  # uuid => body, LRU
+        self.search_index = search.TokenIndex()
+
+    def __contains__(self, uuid):
+        return uuid in self.index
+
+    def get(self, uuid):
+        """Returns the note, or None."""
+        if uuid not in self.index:
+            return None
+
+        body = self.cache.pop(uuid, None)
+        if body is None:
+            row = self.conn.execute("SELECT body FROM notes WHERE uuid = ?",
+                                    (uuid, )).fetchone()
+            if row is None:
+                self.index.discard(uuid)
+                return None
+            body = row[0]
+
+        self._cache(uuid, body)
+        return body
+
+    def set(self, uuid, body):
+        """Saves the note, an empty one is deleted.  Every change is a
+        transaction, so a note is either saved or not."""
+        if isinstance(body, str):
+            body = body.decode("utf-8")
+        if body == self.get(uuid) or (not body and uuid not in self.index):
+            return
+
+        with self.conn:
+            if body:
+                self.conn.execute("INSERT OR REPLACE INTO notes "
+                                  "(uuid, modified, body) VALUES (?, ?, ?)",
+                                  (uuid, int(time.time()), body))
+            else:
+                self.conn.execute("DELETE FROM notes WHERE uuid = ?",
+                                  (uuid, ))
+
+        if body:
+            self.index.add(uuid)
+            self._cache(uuid, body)
+        else:
+            self.index.discard(uuid)
+            self.cache.pop(uuid, None)
+
+        self.search_index.update(uuid, body)
+
+    def build_search_index(self, callback=None):
+        """Indexes all notes in the background."""
+        def load():
+            # SQLite connections can't be shared between threads.
+            conn = sqlite3.connect(self.path)
+            try:
+                return conn.execute("SELECT uuid, body FROM notes").fetchall()
+            finally:
+                conn.close()
+
+        self.search_index.build(load, callback)
+
+    def search(self, query):
+        """Returns uuids of tasks with notes matching the query."""
+        return self.search_index.search(query)
+
+    def _cache(self, uuid, body):
+        self.cache[uuid] = body
+        if len(self.cache) > CACHE_SIZE:
+            self.cache.popitem(last=False)
+
+    def migrate(self, folder):
+        """Moves notes from a folder with one file per task into the
+        database.  The folder is renamed, not deleted."""
+        names = [n for n in os.listdir(folder)
+                 if os.path.isfile(os.path.join(folder, n))]
+
+        rows = []
+        for name in names:
+            path = os.path.join(folder, name)
+            with open(path, "rb") as f:
+                body = f.read().decode("utf-8", "replace")
+            if body and name not in self.index:
+                rows.append((name, int(os.stat(path).st_mtime), body))
+
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO notes "
+                                  "(uuid, modified, body) VALUES (?, ?, ?)",
+                                  rows)
+        self.index.update(row[0] for row in rows)
+
+        # Earlier migrations (or synced dotfiles) can leave a renamed
+        # folder behind, which is kept too.
+        target = folder + ".migrated"
+        count = 1
+        while os.path.exists(target):
+            count += 1
+            target = "%s.migrated.%u" % (folder, count)
+
+        try:
+            os.rename(folder, target)
+        except OSError, e:
+            util.log("Can't rename {0} to {1}: {2}", folder, target, e)
+
+        util.log("Moved {0} notes from {1} to {2}.", len(rows), folder,
+                 self.path)
+
+
+_store = None
+
+
+def get_store():
+    """Returns the note store for the current TaskWarrior database."""
+    global _store
+
+    if _store is None:
+        folder = taskrc.get_config().get_data_location()
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        _store = NoteStore(os.path.join(folder, "notes.sqlite"))
+
+        legacy = os.path.expanduser(LEGACY_FOLDER)
+        if os.path.isdir(legacy):
+            try:
+                _store.migrate(legacy)
+            except (EnvironmentError, sqlite3.Error), e:
+                util.log("Can't migrate notes from {0}: {1}", legacy, e)
+
+    return _store
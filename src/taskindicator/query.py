@@ -0,0 +1,154 @@
+# encoding=utf-8
+
+"""
+Search queries.
+
+A query is a list of terms:
+
+    word, "some phrase"     text or notes must contain it
+    -word                   text must not contain it, and no such tag
+    +tag                    the task has the tag
+    project:name            the project is name or its subproject
+    status:completed        pending, waiting, completed, deleted
+    pri:H, pri:             priority, or no priority
+    urgency>5, urgency<1    urgency above or below the value
+    due.before:2015-02-01   also due.after, and other dates: entry,
+                            modified, start, end, wait, scheduled;
+                            now, today, tomorrow, yesterday work too
+
+Queries are compiled once into a predicate, which works on task fields
+directly, and a list of words for the text indexes (see search.py).
+"""
+
+import re
+import time
+
+from taskindicator import util
+
+
+TERM = re.compile(r'(-?[\w.]+[:<>]"[^"]*"|"[^"]*"|\S+)', re.UNICODE)
+FILTER = re.compile(r"^([a-z]+)(?:\.([a-z]+))?([:<>])(.*)$")
+
+DATES = ("entry", "modified", "start", "end", "due", "wait", "scheduled")
+
+CLOSED = ("completed", "deleted")
+
+
+def parse_date(value):
+    """Converts a query date to a timestamp."""
+    day = time.mktime(time.localtime()[:3] + (0, 0, 0, 0, 0, -1))
+    named = {"now": time.time(), "today": day,
+             "yesterday": day - 86400, "tomorrow": day + 86400}
+    if value in named:
+        return int(named[value])
+    return util.parse_date(value.upper())
+
+
+class Query(object):
+    def __init__(self, text):
+        self.words = []  # must be in the text or notes
+        self.excluded = []  # must not be in the text
+        self.filters = []  # functions of the task
+        self.closed = False  # needs completed or deleted tasks
+
+        for term in TERM.findall(text.lower()):
+            term = term.replace('"', "")
+            if term in ("", "-", "+"):
+                continue
+            if term.startswith("+") and len(term) > 1:
+                self.filters.append(self.has_tag(term[1:]))
+            elif term.startswith("-") and len(term) > 1:
+                self.excluded.append(term[1:])
+                self.filters.append(self.negate(self.has_tag(term[1:])))
+            elif not self.add_filter(term):
+                self.words.append(term)
+
+    def __call__(self, task):
+        """Returns True if the task matches the filters (words are checked
+        with the indexes)."""
+        for func in self.filters:
+            if not func(task):
+                return False
+        return True
+
+    def add_filter(self, term):
+        """Compiles an attribute filter, returns False if the term is not
+        one, e.g. a url."""
+        m = FILTER.match(term)
+        if m is None:
+            return False
+
+        name, modifier, op, value = m.groups()
+        try:
+            if name in DATES and op == ":" and modifier in ("before",
+                                                            "after"):
+                func = self.compare_date(name, modifier, parse_date(value))
+            elif modifier:
+                return False
+            elif name == "project" and op == ":":
+                func = self.in_project(value)
+            elif name == "status" and op == ":":
+                func = self.has_status(value)
+            elif name in ("pri", "priority") and op == ":":
+                func = self.has_priority(value)
+            elif name == "urgency" and op in "<>":
+                func = self.compare_urgency(op, float(value))
+            else:
+                return False
+        except ValueError, e:
+            util.log("Bad query term {0}: {1}", term, e)
+            return False
+
+        self.filters.append(func)
+        return True
+
+    def negate(self, func):
+        return lambda task: not func(task)
+
+    def has_tag(self, tag):
+        cache = {}  # tags tuples are shared, see record.intern_list
+
+        def check(task):
+            tags = task["tags"] or ()
+            found = cache.get(tags)
+            if found is None:
+                found = cache[tags] = tag in [t.lower() for t in tags]
+            return found
+        return check
+
+    def in_project(self, name):
+        cache = {}  # project names are shared too
+
+        def check(task):
+            project = task["project"]
+            found = cache.get(project)
+            if found is None:
+                p = (project or u"").lower()
+                found = cache[project] = (p == name
+                                          or p.startswith(name + "."))
+            return found
+        return check
+
+    def has_status(self, status):
+        if status in CLOSED:
+            self.closed = True
+        return lambda task: task["status"] == status
+
+    def has_priority(self, priority):
+        priority = priority.upper() or None
+        return lambda task: (task["priority"] or None) == priority
+
+    def compare_urgency(self, op, value):
+        if op == ">":
+            return lambda task: (task["urgency"] or 0) > value
+        return lambda task: (task["urgency"] or 0) < value
+
+    def compare_date(self, name, modifier, ts):
+        if modifier == "before":
+            return lambda task: task[name] is not None and task[name] < ts
+        return lambda task: task[name] is not None and task[name] > ts
+
+
+def compile(text):
+    """Returns a Query object for the text."""
+    return Query(text)
@@ -0,0 +1,120 @@
+# encoding=utf-8
+
+"""
+Recently modified tasks and open tasks by project, for the tray menu.
+
+RecentTasks keeps the most recently modified pending tasks, a few more
+than the menu shows, in a small sorted list.  Changed tasks are moved one
+at a time; all tasks are only scanned when the database is reloaded, or
+when closed tasks leave too few of them.
+
+ProjectIndex groups open tasks by project, for the project submenus, which
+only look at the tasks of one project when opened.
+"""
+
+import bisect
+import heapq
+
+
+class RecentTasks(object):
+    """The size most recently modified pending tasks, with room for as many
+    more.  Every task which is not kept was modified before all kept ones,
+    so the first count kept tasks are the ones to show."""
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = []  # sorted (modified, uuid), oldest first
+        self.records = {}  # uuid => task
+        self.complete = True  # all pending tasks are kept
+        self.stale = False  # too few kept, must be rebuilt
+
+    def rebuild(self, tasks):
+        """Finds the most recent tasks in a task list."""
+        pending = [task for task in tasks if task["status"] == "pending"]
+        recent = heapq.nlargest(self.size * 2, pending, key=get_key)
+
+        self.records = dict((task["uuid"], task) for task in recent)
+        self.entries = sorted((get_key(task), task["uuid"])
+                              for task in recent)
+        self.complete = len(recent) == len(pending)
+        self.stale = False
+
+    def update(self, task):
+        """Moves a changed task, drops it if it's not pending any more."""
+        uuid = task["uuid"]
+        old = self.records.pop(uuid, None)
+        if old is not None:
+            del self.entries[bisect.bisect_left(self.entries,
+                                                (get_key(old), uuid))]
+
+        if is_pending(task):
+            entry = (get_key(task), uuid)
+            if self.complete or (self.entries and entry > self.entries[0]):
+                bisect.insort(self.entries, entry)
+                self.records[uuid] = task
+                if len(self.entries) > self.size * 2:
+                    self.records.pop(self.entries.pop(0)[1])
+                    self.complete = False
+
+        if len(self.entries) < self.size and not self.complete:
+            self.stale = True
+
+    def get(self, count):
+        """Returns the count most recent tasks, newest first."""
+        return [self.records[uuid] for key, uuid in
+                reversed(self.entries[-count:])] if count else []
+
+
+class ProjectIndex(object):
+    """Open tasks which have a project, by project."""
+
+    def __init__(self):
+        self.projects = {}  # project => {task id: task}
+        self.task_projects = {}  # task id => project
+
+    def rebuild(self, tasks):
+        self.projects = {}
+        self.task_projects = {}
+        for task in tasks:
+            project = task["project"]
+            if project and not task.is_closed():
+                task_id = task.id()
+                if project not in self.projects:
+                    self.projects[project] = {}
+                self.projects[project][task_id] = task
+                self.task_projects[task_id] = project
+
+    def update(self, task):
+        """Moves a changed task to its project, drops it if it's closed."""
+        task_id = task.id()
+        old = self.task_projects.pop(task_id, None)
+        if old is not None:
+            tasks = self.projects[old]
+            del tasks[task_id]
+            if not tasks:
+                del self.projects[old]
+
+        project = task["project"]
+        if project and not task.is_closed():
+            self.projects.setdefault(project, {})[task_id] = task
+            self.task_projects[task_id] = project
+
+    def names(self):
+        """Returns names of projects which have open tasks, sorted."""
+        return sorted(self.projects, key=lambda name: name.lower())
+
+    def count(self, project):
+        return len(self.projects.get(project, ()))
+
+    def get(self, project, count):
+        """Returns the count most urgent tasks of the project."""
+        return heapq.nlargest(count, self.projects.get(project, {}).values(),
+                              key=lambda task: task["urgency"] or 0)
+
+
+def is_pending(task):
+    return task["status"] == "pending"
+
+
+def get_key(task):
+    return task["modified"] or 0
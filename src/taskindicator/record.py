@@ -0,0 +1,202 @@
+# encoding=utf-8
+
+"""
+Compact task records.
+
+A Record works like a dict, but known fields are kept in __slots__, which
+takes a fraction of the memory of a dict per task.  Values which repeat a
+lot (status, project, tags) are interned, so that all tasks share the same
+string objects, timestamps are stored as integers.  Unknown fields go to a
+dict, which is only created when needed.
+
+A field which is not set (or set to None) is missing: "start" in task is
+False and task["start"] is None.
+"""
+
+from taskindicator import util
+
+
+_strings = {}
+_lists = {}  # comma separated string => intern_list result
+_setters = {}  # class => Record.get_setters result
+
+
+def intern_string(value):
+    """Returns a shared copy of the string."""
+    if value is None:
+        return None
+    return _strings.setdefault(value, value)
+
+
+def intern_list(value):
+    """Returns a shared tuple of shared strings."""
+    if value is None:
+        return None
+    if isinstance(value, basestring):
+        result = _lists.get(value)
+        if result is None:
+            result = _lists[value] = intern_list(value.split(","))
+        return result
+    return intern_string(tuple(intern_string(v) for v in value if v))
+
+
+def ascii_string(value):
+    """Stores ASCII only values, like uuids, as byte strings, which take a
+    quarter of the space of unicode ones."""
+    if isinstance(value, unicode):
+        try:
+            return value.encode("ascii")
+        except UnicodeEncodeError:
+            pass
+    return value
+
+
+def timestamp(value):
+    """Converts dates to integers.  The data files have UNIX timestamps,
+    exported tasks have ISO dates."""
+    if value is None or value == "":
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return util.parse_date(value)
+
+
+class Record(object):
+    __slots__ = ("_extra", )
+
+    # Field names, stored in slots named "_" + field.  Subclasses must list
+    # them in __slots__ too.
+    FIELDS = ()
+    ATTRS = {}
+
+    # Functions which convert values on assignment.
+    CONVERTERS = {}
+
+    def __init__(self, data=(), **kwargs):
+        self.update(data, **kwargs)
+
+    def __repr__(self):
+        return "<%s %r>" % (self.__class__.__name__, dict(self.items()))
+
+    def __getitem__(self, key):
+        attr = self.ATTRS.get(key)
+        if attr is not None:
+            return getattr(self, attr, None)
+        extra = getattr(self, "_extra", None)
+        if extra is not None:
+            return extra.get(key)
+
+    def __setitem__(self, key, value):
+        conv = self.CONVERTERS.get(key)
+        if conv is not None:
+            value = conv(value)
+
+        attr = self.ATTRS.get(key)
+        if attr is not None:
+            setattr(self, attr, value)
+        else:
+            self._set_extra(key, value)
+
+    def _set_extra(self, key, value):
+        extra = getattr(self, "_extra", None)
+        if extra is None:
+            extra = self._extra = {}
+        if value is None:
+            extra.pop(key, None)
+        else:
+            extra[key] = value
+
+    def __delitem__(self, key):
+        self[key] = None
+
+    def __contains__(self, key):
+        return self[key] is not None
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def get(self, key, default=None):
+        value = self[key]
+        if value is None:
+            return default
+        return value
+
+    def keys(self):
+        keys = [k for k in self.FIELDS
+                if getattr(self, self.ATTRS[k], None) is not None]
+        extra = getattr(self, "_extra", None)
+        if extra:
+            keys += extra.keys()
+        return keys
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    iteritems = items
+
+    def update(self, data=(), **kwargs):
+        if hasattr(data, "keys"):
+            data = [(k, data[k]) for k in data.keys()]
+        if kwargs:
+            data = list(data) + kwargs.items()
+        self._load(data)
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        """Creates a record from (key, value) pairs, without the checks
+        the constructor does, for loading many records."""
+        record = cls.__new__(cls)
+        record._load(pairs)
+        return record
+
+    def _load(self, pairs):
+        # Same as __setitem__, inlined for faster loading.
+        setters = _setters.get(self.__class__)
+        if setters is None:
+            setters = self.get_setters()
+        for k, v in pairs:
+            setter = setters.get(k)
+            if setter is not None:
+                attr, conv = setter
+                if conv is not None:
+                    v = conv(v)
+                setattr(self, attr, v)
+            else:
+                self[k] = v
+
+    @classmethod
+    def get_setters(cls):
+        """Returns {field: (slot, converter)}, built once per class, so that
+        loading takes one lookup per value."""
+        setters = _setters.get(cls)
+        if setters is None:
+            setters = _setters[cls] = dict(
+                (k, (attr, cls.CONVERTERS.get(k)))
+                for k, attr in cls.ATTRS.items())
+        return setters
+
+    def dump(self):
+        """Returns the values as a tuple of simple types, for caching."""
+        values = [getattr(self, self.ATTRS[f], None) for f in self.FIELDS]
+        values.append(getattr(self, "_extra", None))
+        return tuple(values)
+
+    def copy(self):
+        record = self.restore(self.dump())
+        extra = getattr(record, "_extra", None)
+        if extra:
+            record._extra = dict(extra)
+        return record
+
+    @classmethod
+    def restore(cls, values):
+        """Creates a record from values returned by dump()."""
+        record = cls.from_pairs([(k, v) for k, v in zip(cls.FIELDS, values)
+                                 if v is not None])
+        if values[-1]:
+            record._extra = values[-1]
+        return record
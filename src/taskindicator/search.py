@@ -0,0 +1,401 @@
+# encoding=utf-8
+
+"""
+Search indexes.
+
+TokenIndex maps words to the tasks whose text (notes) contains them, so
+that the search dialog can look up matching notes without reading them.
+The index is built in a background thread, and updated one task at a time
+when notes change.
+
+TextIndex finds substrings in short task texts (project, summary) and
+ids, using trigrams to narrow down the tasks which need to be checked.
+
+SortedIndex keeps tasks ordered by a sort key, moving only the tasks which
+changed.
+
+fuzzy_score ranks approximate matches, fzf style: the query characters
+must appear in the text in order, matches at word starts and runs of
+consecutive characters score higher, gaps lower.
+"""
+
+import bisect
+import re
+import threading
+
+import gobject
+
+from taskindicator import util
+
+
+WORD = re.compile(r"\w+", re.UNICODE)
+
+# Words which can be a part of a task id or uuid.
+ID_WORD = re.compile(r"^[0-9a-f-]+$")
+
+# With more changed tasks, SortedIndex sorts them all again.
+MAX_MOVES = 1000
+
+# Tasks checked or listed at a time by the *_steps methods, which let the
+# search dialog split long operations, see Search.filter_step.
+STEP = 5000
+
+# Fuzzy match scores, see fuzzy_score.
+SCORE_MATCH = 16
+BONUS_BOUNDARY = 8
+BONUS_CONSECUTIVE = 4
+PENALTY_GAP_START = 3
+PENALTY_GAP_EXTENSION = 1
+
+
+def tokenize(text):
+    """Returns the set of lowercase words in the text."""
+    if not text:
+        return frozenset()
+    if isinstance(text, str):
+        text = text.decode("utf-8", "replace")
+    return frozenset(WORD.findall(text.lower()))
+
+
+class TokenIndex(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tokens = {}  # word => set of task ids
+        self.docs = {}  # task id => words
+        self.vocabulary = None  # sorted words, for prefix search
+        self.ready = False
+        self.touched = set()  # task ids updated while building
+
+    def build(self, load, callback=None):
+        """Indexes the (task id, text) pairs returned by load(), in a
+        background thread.  When done, callback() is called in the main
+        loop."""
+        thread = threading.Thread(target=self._build, args=(load, callback),
+                                  name="search-index")
+        thread.daemon = True
+        thread.start()
+
+    def _build(self, load, callback):
+        try:
+            docs = [(task_id, tokenize(text)) for task_id, text in load()]
+        except Exception, e:
+            util.log("Error indexing notes: {0}", e)
+            return
+
+        with self.lock:
+            for task_id, words in docs:
+                if task_id not in self.touched:
+                    self._add(task_id, words)
+            self.touched = None
+            self.ready = True
+        util.log("Indexed {0} notes.", len(docs))
+
+        if callback is not None:
+            gobject.idle_add(callback)
+
+    def update(self, task_id, text):
+        """Replaces the indexed text of a task, None removes it."""
+        with self.lock:
+            self._remove(task_id)
+            self._add(task_id, tokenize(text))
+            if self.touched is not None:
+                self.touched.add(task_id)
+
+    def _add(self, task_id, words):
+        if not words:
+            return
+        self.docs[task_id] = words
+        for word in words:
+            if word not in self.tokens:
+                self.tokens[word] = set()
+                self.vocabulary = None
+            self.tokens[word].add(task_id)
+
+    def _remove(self, task_id):
+        for word in self.docs.pop(task_id, ()):
+            ids = self.tokens[word]
+            ids.discard(task_id)
+            if not ids:
+                del self.tokens[word]
+                self.vocabulary = None
+
+    def search(self, query):
+        """Returns ids of tasks which have words starting with each of the
+        query words."""
+        words = tokenize(query)
+        if not words:
+            return set()
+
+        with self.lock:
+            if self.vocabulary is None:
+                self.vocabulary = sorted(self.tokens)
+
+            found = None
+            for word in words:
+                ids = set()
+                pos = bisect.bisect_left(self.vocabulary, word)
+                while pos < len(self.vocabulary) \
+                        and self.vocabulary[pos].startswith(word):
+                    ids |= self.tokens[self.vocabulary[pos]]
+                    pos += 1
+
+                if found is None:
+                    found = ids
+                else:
+                    found &= ids
+                if not found:
+                    break
+
+            return found
+
+
+def trigrams(text):
+    return set(text[i:i + 3] for i in xrange(len(text) - 2))
+
+
+def char_mask(text):
+    """Returns a bit mask of the characters in the text.  If a text has
+    some character which is not in the mask of another, it can't be its
+    subsequence."""
+    mask = 0
+    for c in set(text):
+        mask |= 1 << (ord(c) & 63)
+    return mask
+
+
+def fuzzy_score(word, text):
+    """Returns the score of the shortest match of the word's characters in
+    the text, in order, or None if there's no such match."""
+    pos = -1
+    for c in word:
+        pos = text.find(c, pos + 1)
+        if pos < 0:
+            return None
+
+    # Back from the end of the first match, to its shortest version.
+    start = pos
+    for c in reversed(word[:-1]):
+        start = text.rfind(c, 0, start)
+
+    score = 0
+    prev = pos = start - 1
+    for c in word:
+        pos = text.find(c, pos + 1)
+        score += SCORE_MATCH
+        if pos == 0 or not text[pos - 1].isalnum():
+            score += BONUS_BOUNDARY
+        if pos == prev + 1:
+            if pos != start:
+                score += BONUS_CONSECUTIVE
+        else:
+            score -= PENALTY_GAP_START + PENALTY_GAP_EXTENSION \
+                * (pos - prev - 2)
+        prev = pos
+    return score
+
+
+class TextIndex(object):
+    """Lowercase text of each task, and the tasks which have each trigram.
+    Updated from task lists with sync(), which only indexes tasks which
+    changed since the last time.
+
+    Ids are not in the trigram index, uuids would take most of it.  They're
+    only searched for words which look like (parts of) ids."""
+
+    def __init__(self, get_text):
+        self.get_text = get_text
+        self.records = {}  # task id => task
+        self.texts = {}  # task id => lowercase text
+        self.trigrams = {}  # trigram => set of task ids
+        self.masks = {}  # task id => char_mask of the text and id
+
+    def __len__(self):
+        return len(self.texts)
+
+    def sync(self, tasks):
+        """Indexes the tasks, drops tasks which aren't there any more.
+        Loaded tasks are replaced with new objects when they change, so
+        unchanged tasks are skipped without reading them."""
+        seen = set()
+        for task in tasks:
+            task_id = str(task.id())
+            seen.add(task_id)
+            if self.records.get(task_id) is not task:
+                self.update(task_id, self.get_text(task))
+                self.records[task_id] = task
+
+        for task_id in set(self.texts) - seen:
+            self.remove(task_id)
+
+    def update(self, task_id, text):
+        self.remove(task_id)
+        text = text.lower()
+        self.texts[task_id] = text
+        self.masks[task_id] = char_mask(text + task_id)
+        for trigram in trigrams(text):
+            ids = self.trigrams.get(trigram)
+            if ids is None:
+                ids = self.trigrams[trigram] = set()
+            ids.add(task_id)
+
+    def remove(self, task_id):
+        self.records.pop(task_id, None)
+        self.masks.pop(task_id, None)
+        text = self.texts.pop(task_id, None)
+        if text is not None:
+            for trigram in trigrams(text):
+                ids = self.trigrams[trigram]
+                ids.discard(task_id)
+                if not ids:
+                    del self.trigrams[trigram]
+
+    def find(self, word):
+        """Returns ids of tasks whose text contains the word."""
+        found = set()
+        for _ in self.find_steps(word, found):
+            pass
+        return found
+
+    def find_steps(self, word, found):
+        """Adds ids of tasks whose text contains the word to found.  Yields
+        after every STEP tasks checked, so that long scans (short words
+        check every text) can be done a part at a time."""
+        word = word.lower()
+        if len(word) < 3:
+            candidates = list(self.texts)
+        else:
+            # Texts which have the word have all of its trigrams, checking
+            # the rarest one's is quicker than intersecting them all.
+            candidates = list(min((self.trigrams.get(trigram, ())
+                                   for trigram in trigrams(word)), key=len))
+
+        texts = self.texts
+        for start in xrange(0, len(candidates), STEP):
+            found.update(task_id for task_id in candidates[start:start + STEP]
+                         if word in texts[task_id])
+            yield
+
+        if ID_WORD.match(word):
+            ids = list(texts)
+            for start in xrange(0, len(ids), STEP):
+                found.update(task_id for task_id in ids[start:start + STEP]
+                             if word in task_id)
+                yield
+
+    def fuzzy(self, words, task_id, mask):
+        """Returns the sum of fuzzy scores of the words in the task's text
+        or id, or None if some word doesn't match.  The mask is char_mask
+        of the words."""
+        if mask & ~self.masks.get(task_id, 0):
+            return None
+
+        text = self.texts[task_id]
+        total = 0
+        for word in words:
+            score = fuzzy_score(word, text)
+            if score is None:
+                score = fuzzy_score(word, task_id)
+                if score is None:
+                    return None
+            total += score
+        return total
+
+
+class SortedIndex(object):
+    """Tasks ordered by key(task), which is computed once per change.
+    Updated from task lists with sync(), like TextIndex.  Urgency is
+    updated in place (see urgency.update), so it's checked too."""
+
+    def __init__(self, key):
+        self.key = key
+        self.records = {}  # task id => task
+        self.urgency = {}  # task id => urgency when the key was computed
+        self.keys = {}  # task id => sort key
+        self.entries = []  # sorted (key, task id)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def set_key(self, key):
+        """Changes the order, sorts all tasks again."""
+        self.key = key
+        self.rebuild(self.records.values())
+
+    def rebuild(self, tasks):
+        tasks = list(tasks)
+        ids = [str(task.id()) for task in tasks]
+        keys = map(self.key, tasks)
+        self.records = dict(zip(ids, tasks))
+        self.urgency = dict(zip(ids, [task["urgency"] for task in tasks]))
+        self.keys = dict(zip(ids, keys))
+        self.entries = sorted(zip(keys, ids))
+
+    def sync(self, tasks):
+        """Updates the order to the tasks.  Tasks whose key changed are
+        moved with bisect, unless there are more than MAX_MOVES (e.g.,
+        after a reload), then all tasks are sorted again.  Urgency of open
+        tasks changes with age all the time, the key only when it's
+        rounded differently."""
+        tasks = list(tasks)
+        seen = set()
+        moved = []
+        for task in tasks:
+            task_id = str(task.id())
+            seen.add(task_id)
+            if self.records.get(task_id) is task \
+                    and self.urgency[task_id] == task["urgency"]:
+                continue
+
+            key = self.key(task)
+            if self.keys.get(task_id) != key:
+                moved.append((task_id, task, key))
+            else:
+                self.records[task_id] = task
+                self.urgency[task_id] = task["urgency"]
+
+        removed = [task_id for task_id in self.records
+                   if task_id not in seen]
+
+        if len(moved) + len(removed) > MAX_MOVES:
+            self.rebuild(tasks)
+            return
+
+        for task_id in removed:
+            self.remove(task_id)
+        for task_id, task, key in moved:
+            self.update(task_id, task, key)
+
+    def update(self, task_id, task, key=None):
+        if key is None:
+            key = self.key(task)
+        if self.keys.get(task_id) != key:
+            self.remove(task_id)
+            bisect.insort(self.entries, (key, task_id))
+            self.keys[task_id] = key
+        self.records[task_id] = task
+        self.urgency[task_id] = task["urgency"]
+
+    def remove(self, task_id):
+        key = self.keys.pop(task_id, None)
+        if key is not None:
+            pos = bisect.bisect_left(self.entries, (key, task_id))
+            del self.entries[pos]
+        self.records.pop(task_id, None)
+        self.urgency.pop(task_id, None)
+
+    def ordered(self, count=None):
+        """Returns the tasks in order, or the first count of them."""
+        tasks = []
+        for _ in self.ordered_steps(tasks, count):
+            pass
+        return tasks
+
+    def ordered_steps(self, tasks, count=None):
+        """Same as ordered, but appends the tasks to a list, yielding after
+        every STEP of them."""
+        records = self.records
+        entries = self.entries[:count]
+        for start in xrange(0, len(entries), STEP):
+            tasks.extend(records[task_id]
+                         for key, task_id in entries[start:start + STEP])
+            yield
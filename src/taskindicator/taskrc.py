@@ -0,0 +1,145 @@
+# encoding=utf-8
+
+"""
+TaskWarrior configuration reader.
+
+Reads ~/.taskrc (or $TASKRC) and the files it includes directly, instead of
+spawning "task _show" every time a setting is needed.  The parsed values
+are cached and only read again when one of the files changes.  TaskWarrior
+itself is only asked when the configuration file can't be read.
+"""
+
+import os
+
+from taskindicator import util
+
+
+DEFAULT_RC = "~/.taskrc"
+DEFAULT_DATA_LOCATION = "~/.task"
+
+# Where relative includes, like themes, are looked up after the folder of
+# the including file.
+INCLUDE_FOLDERS = [
+    "/usr/share/taskwarrior",
+    "/usr/local/share/doc/task/rc",
+    "/usr/share/doc/task/rc",
+]
+
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+class TaskRC(object):
+    def __init__(self, path=None):
+        if path is None:
+            path = os.getenv("TASKRC") or DEFAULT_RC
+        self.path = os.path.expanduser(path)
+        self._values = None
+        self._files = []  # (path, mtime) of every file read
+
+    def is_stale(self):
+        """Returns True if any of the configuration files changed since
+        they were read."""
+        if self._values is None:
+            return True
+        for path, mtime in self._files:
+            if get_mtime(path) != mtime:
+                return True
+        return False
+
+    def get_values(self):
+        if self.is_stale():
+            self._values = self.load()
+        return self._values
+
+    def get(self, key, default=None):
+        return self.get_values().get(key, default)
+
+    def items(self):
+        return self.get_values().items()
+
+    def get_data_location(self):
+        location = os.getenv("TASKDATA") or self.get("data.location")
+        return os.path.expanduser(location or DEFAULT_DATA_LOCATION)
+
+    def load(self):
+        values = {}
+        self._files = [(self.path, get_mtime(self.path))]
+
+        if self._files[0][1] is None:
+            util.log("Config file {0} not found, asking TaskWarrior.",
+                     self.path)
+            return self.load_from_task()
+
+        try:
+            self.read_file(self.path, values)
+        except IOError, e:
+            util.log("Error reading {0}: {1}, asking TaskWarrior.",
+                     self.path, e)
+            return self.load_from_task()
+
+        return values
+
+    def load_from_task(self):
+        """Reads the configuration using TaskWarrior itself."""
+        values = {}
+        out = util.run_command(["task", "_show"], fail=False)
+        for line in out.split("\n"):
+            if "=" in line:
+                k, v = line.split("=", 1)
+                values[k.strip()] = v.strip()
+        return values
+
+    def read_file(self, path, values, depth=0):
+        with open(path, "rb") as f:
+            for line in f:
+                line = line.split("#", 1)[0].strip()
+                if not line:
+                    continue
+
+                if line.startswith("include "):
+                    if depth < 10:
+                        self.read_include(path, line[8:].strip(), values,
+                                          depth + 1)
+                    continue
+
+                if "=" in line:
+                    k, v = line.split("=", 1)
+                    values[k.strip()] = v.strip()
+
+    def read_include(self, parent, name, values, depth):
+        name = os.path.expanduser(name)
+        if os.path.isabs(name):
+            candidates = [name]
+        else:
+            folders = [os.path.dirname(parent)] + INCLUDE_FOLDERS
+            candidates = [os.path.join(f, name) for f in folders]
+
+        for path in candidates:
+            mtime = get_mtime(path)
+            if mtime is not None:
+                self._files.append((path, mtime))
+                try:
+                    self.read_file(path, values, depth)
+                except IOError, e:
+                    util.log("Error reading {0}: {1}", path, e)
+                return
+
+        # Watch the first location, in case it's created later.
+        self._files.append((candidates[0], None))
+        util.log("Included config file {0} not found.", name)
+
+
+_config = None
+
+
+def get_config():
+    """Returns the shared configuration instance."""
+    global _config
+    if _config is None:
+        _config = TaskRC()
+    return _config
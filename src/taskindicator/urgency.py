@@ -0,0 +1,243 @@
+# encoding=utf-8
+
+"""
+Task urgency calculator.
+
+Computes the same urgency values as TaskWarrior does, using the urgency.*
+coefficients from the user's configuration, so that "task export" doesn't
+have to be run just to get them.  Follows the TaskWarrior 2.x formulas.
+"""
+
+import time
+
+from taskindicator import taskrc
+from taskindicator import util
+
+
+DEFAULTS = {
+    "urgency.active.coefficient": 4.0,
+    "urgency.age.coefficient": 2.0,
+    "urgency.age.max": 365.0,
+    "urgency.annotations.coefficient": 1.0,
+    "urgency.blocked.coefficient": -5.0,
+    "urgency.blocking.coefficient": 8.0,
+    "urgency.due.coefficient": 12.0,
+    "urgency.project.coefficient": 1.0,
+    "urgency.scheduled.coefficient": 5.0,
+    "urgency.tags.coefficient": 1.0,
+    "urgency.waiting.coefficient": -3.0,
+    "urgency.user.tag.next.coefficient": 15.0,
+    "urgency.uda.priority.H.coefficient": 6.0,
+    "urgency.uda.priority.M.coefficient": 3.9,
+    "urgency.uda.priority.L.coefficient": 1.8,
+}
+
+# Used with urgency.priority.coefficient, which older versions had.
+LEGACY_PRIORITY = {"H": 1.0, "M": 0.65, "L": 0.3}
+
+OPEN = ("pending", "waiting")
+
+
+def count_factor(count):
+    """Maps the number of tags or annotations to 0.0-1.0."""
+    if count >= 3:
+        return 1.0
+    elif count == 2:
+        return 0.9
+    elif count == 1:
+        return 0.8
+    return 0.0
+
+
+def get_depends(task):
+    depends = task["depends"] or []
+    if isinstance(depends, basestring):
+        depends = depends.split(",")
+    return [d for d in depends if d]
+
+
+class Urgency(object):
+    def __init__(self, config):
+        coefficients = dict(DEFAULTS)
+
+        # Older versions had fixed priority values scaled by a coefficient.
+        legacy = config.get("urgency.priority.coefficient")
+        if legacy is not None:
+            for k, v in LEGACY_PRIORITY.items():
+                coefficients["urgency.uda.priority.%s.coefficient" % k] = \
+                    float(legacy) * v
+
+        legacy = config.get("urgency.next.coefficient")
+        if legacy is not None:
+            coefficients["urgency.user.tag.next.coefficient"] = legacy
+
+        for k, v in config.items():
+            if k.startswith("urgency."):
+                coefficients[k] = v
+
+        def get(key):
+            try:
+                return float(coefficients.get(key, 0.0))
+            except ValueError:
+                util.log("Bad urgency coefficient {0}={1}",
+                         key, coefficients[key])
+                return float(DEFAULTS.get(key, 0.0))
+
+        self.active = get("urgency.active.coefficient")
+        self.age = get("urgency.age.coefficient")
+        self.age_max = get("urgency.age.max")
+        self.annotations = get("urgency.annotations.coefficient")
+        self.blocked = get("urgency.blocked.coefficient")
+        self.blocking = get("urgency.blocking.coefficient")
+        self.due = get("urgency.due.coefficient")
+        self.project = get("urgency.project.coefficient")
+        self.scheduled = get("urgency.scheduled.coefficient")
+        self.tags = get("urgency.tags.coefficient")
+        self.waiting = get("urgency.waiting.coefficient")
+
+        # Per tag, project, keyword and UDA coefficients.
+        self.user_tags = {}
+        self.user_projects = {}
+        self.user_keywords = {}
+        self.uda = {}  # attribute name => coefficient
+        self.uda_values = {}  # attribute name => {value: coefficient}
+
+        for key in coefficients:
+            if not key.endswith(".coefficient"):
+                continue
+            name = key[:-12]
+            if name.startswith("urgency.user.tag."):
+                self.user_tags[name[17:]] = get(key)
+            elif name.startswith("urgency.user.project."):
+                self.user_projects[name[21:]] = get(key)
+            elif name.startswith("urgency.user.keyword."):
+                self.user_keywords[name[21:]] = get(key)
+            elif name.startswith("urgency.uda."):
+                name = name[12:]
+                if "." in name:
+                    attr, value = name.split(".", 1)
+                    self.uda_values.setdefault(attr, {})[value] = get(key)
+                else:
+                    self.uda[name] = get(key)
+
+    def update(self, tasks, now=None, cached=False):
+        """Computes urgency for all tasks, in place.  Blocked and blocking
+        status depends on other tasks, so all of them must be passed.
+
+        Closed tasks keep the urgency they were given when first read, which
+        only changes with age, to keep refreshes of long histories (and
+        tasks loaded from cache) cheap.  With cached=True, open tasks keep
+        it too, only tasks which have none are computed."""
+        if now is None:
+            now = time.time()
+
+        if cached and all(task["urgency"] is not None for task in tasks):
+            return
+
+        open_tasks = set()
+        blocking = set()
+        for task in tasks:
+            if task["status"] in OPEN:
+                open_tasks.add(task["uuid"])
+                if task["depends"]:
+                    blocking.update(get_depends(task))
+        blocking &= open_tasks
+
+        for task in tasks:
+            if task["urgency"] is None or (task["status"] in OPEN
+                                           and not cached):
+                task["urgency"] = self.get_urgency(task, now, open_tasks,
+                                                   blocking)
+
+    def get_urgency(self, task, now, open_tasks, blocking):
+        value = 0.0
+
+        status = task["status"]
+        project = task["project"]
+        tags = [t for t in task["tags"] if t]
+
+        if project:
+            value += self.project
+
+        if task["start"]:
+            value += self.active
+
+        scheduled = task["scheduled"]
+        if scheduled and scheduled < now:
+            value += self.scheduled
+
+        if status == "waiting":
+            value += self.waiting
+
+        if status in OPEN:
+            if task["depends"]:
+                if any(d in open_tasks for d in get_depends(task)):
+                    value += self.blocked
+            if task["uuid"] in blocking:
+                value += self.blocking
+
+        if self.annotations:
+            count = len([k for k in task if k.startswith("annotation_")])
+            value += count_factor(count) * self.annotations
+
+        value += count_factor(len(tags)) * self.tags
+
+        due = task["due"]
+        if due:
+            overdue = (now - due) / 86400.0
+            if overdue >= 7.0:
+                value += self.due
+            elif overdue >= -14.0:
+                value += ((overdue + 14.0) * 0.8 / 21.0 + 0.2) * self.due
+            else:
+                value += 0.2 * self.due
+
+        entry = task["entry"]
+        if self.age and entry:
+            age = (now - entry) / 86400.0
+            if self.age_max == 0 or age > self.age_max:
+                value += self.age
+            else:
+                value += age / self.age_max * self.age
+
+        for tag in tags:
+            value += self.user_tags.get(tag, 0.0)
+
+        if project:
+            for name, coefficient in self.user_projects.items():
+                if project.startswith(name):
+                    value += coefficient
+
+        if self.user_keywords:
+            description = task["description"] or u""
+            for word, coefficient in self.user_keywords.items():
+                if word in description:
+                    value += coefficient
+
+        for attr, coefficient in self.uda.items():
+            if task[attr]:
+                value += coefficient
+
+        for attr, values in self.uda_values.items():
+            value += values.get(task[attr], 0.0)
+
+        return value
+
+
+_urgency = None
+
+
+def update(tasks, config=None, cached=False):
+    """Computes urgency for the tasks using the current configuration.
+    Coefficients are re-read when the configuration changes.  See
+    Urgency.update for cached."""
+    global _urgency
+
+    if config is None:
+        config = taskrc.get_config()
+
+    if _urgency is None or config.is_stale():
+        _urgency = Urgency(config)
+
+    _urgency.update(tasks, cached=cached)
+    return tasks
@@ -2,11 +2,13 @@
 
 from __future__ import print_function
 
+import bisect
 import calendar
 import datetime
 import json
 import subprocess
 import sys
+import time
 
 import pygtk
 pygtk.require("2.0")
@@ -46,6 +48,59 @@ def strip_description(text):
     return " ".join(words).strip()
 
 
+def parse_date(value):
+    """
+    Converts an ISO 8601 date to a UNIX timestamp.
+
+    Handles the fixed formats TaskWarrior uses in export and hooks,
+    20130201T103640Z, and the same with separators, 2013-02-01T10:36:40Z,
+    by slicing, which is much faster than a generic parser.  Dates without
+    the Z suffix, including plain dates like 2013-02-01, are local time.
+    """
+    v = value.replace("-", "").replace(":", "")
+
+    utc = v.endswith("Z")
+    if utc:
+        v = v[:-1]
+
+    if len(v) == 15 and v[8] == "T":
+        parts = (int(v[0:4]), int(v[4:6]), int(v[6:8]),
+                 int(v[9:11]), int(v[11:13]), int(v[13:15]))
+    elif len(v) == 8 and v.isdigit():
+        parts = (int(v[0:4]), int(v[4:6]), int(v[6:8]), 0, 0, 0)
+    else:
+        raise ValueError("Unsupported date format: %s" % value)
+
+    if utc:
+        return calendar.timegm(parts)
+    return int(time.mktime(parts + (0, 0, -1)))
+
+
+def longest_increasing(seq):
+    """Returns indexes of the longest increasing subsequence of seq."""
+    tails = []  # tails[n] = index of the smallest tail of length n + 1
+    prev = [None] * len(seq)
+    values = []
+    for i, value in enumerate(seq):
+        n = bisect.bisect_left(values, value)
+        if n:
+            prev[i] = tails[n - 1]
+        if n == len(tails):
+            tails.append(i)
+            values.append(value)
+        else:
+            tails[n] = i
+            values[n] = value
+
+    result = []
+    i = tails[-1] if tails else None
+    while i is not None:
+        result.append(i)
+        i = prev[i]
+    result.reverse()
+    return result
+
+
 def get_icon_path(icon_name):
     theme = gtk.icon_theme_get_default()
 
@@ -0,0 +1,148 @@
+# encoding=utf-8
+
+"""
+Database change watcher.
+
+Watches the database files and calls back (in the main loop) when any of
+them changes.  Uses inotify where available, which means no wakeups at all
+while nothing changes; falls back to checking file stats periodically.
+Bursts of changes, like TaskWarrior rewriting several files in a row, are
+reported once.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+
+import gobject
+
+from taskindicator import util
+
+
+DEBOUNCE = 50  # milliseconds
+POLL_FREQUENCY = 1  # seconds
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+IN_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO \
+    | IN_CREATE | IN_DELETE
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class Watcher(object):
+    def __init__(self, paths, callback):
+        self.paths = [os.path.abspath(p) for p in paths]
+        self.callback = callback
+        self._timer = None
+
+    def changed(self):
+        """Schedules the callback, postponing it while changes keep
+        coming."""
+        if self._timer is not None:
+            gobject.source_remove(self._timer)
+        self._timer = gobject.timeout_add(DEBOUNCE, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self.callback()
+        return False
+
+
+class PollWatcher(Watcher):
+    """Checks file stats every POLL_FREQUENCY seconds."""
+
+    def __init__(self, paths, callback):
+        super(PollWatcher, self).__init__(paths, callback)
+        self.stats = self.get_stats()
+        gobject.timeout_add(POLL_FREQUENCY * 1000, self._on_poll)
+
+    def get_stats(self):
+        stats = []
+        for path in self.paths:
+            try:
+                st = os.stat(path)
+                stats.append((st.st_ino, st.st_size, st.st_mtime))
+            except OSError:
+                stats.append(None)
+        return stats
+
+    def _on_poll(self):
+        stats = self.get_stats()
+        if stats != self.stats:
+            self.stats = stats
+            self.changed()
+        return True
+
+
+class InotifyWatcher(Watcher):
+    """Watches the folders which contain the files, so that files replaced
+    with rename are also noticed."""
+
+    def __init__(self, paths, callback):
+        super(InotifyWatcher, self).__init__(paths, callback)
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.names = {}  # watch descriptor => watched file names
+        folders = {}
+        for path in self.paths:
+            folder, name = os.path.split(path)
+            folders.setdefault(folder, set()).add(name)
+
+        for folder, names in folders.items():
+            wd = libc.inotify_add_watch(self.fd, folder, IN_MASK)
+            if wd < 0:
+                code = ctypes.get_errno()
+                os.close(self.fd)
+                raise OSError(code, "Could not watch %s" % folder)
+            self.names[wd] = names
+
+        gobject.io_add_watch(self.fd, gobject.IO_IN, self._on_events)
+
+    def _on_events(self, fd, condition):
+        try:
+            data = os.read(fd, 65536)
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                util.log("Error reading inotify events: {0}", e)
+            return True
+
+        found = False
+        pos = 0
+        while pos + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, size = EVENT_HEADER.unpack_from(data, pos)
+            pos += EVENT_HEADER.size
+            name = data[pos:pos + size].rstrip("\0")
+            pos += size
+
+            if name in self.names.get(wd, ()):
+                found = True
+
+        if found:
+            self.changed()
+        return True
+
+
+def create(paths, callback):
+    """Returns the best available watcher for the files."""
+    try:
+        watcher = InotifyWatcher(paths, callback)
+        util.log("Watching database files with inotify.")
+        return watcher
+    except (OSError, AttributeError), e:
+        util.log("Can't use inotify ({0}), polling database files.", e)
+        return PollWatcher(paths, callback)
@@ -0,0 +1,68 @@
+# encoding=utf-8
+
+"""
+Background writer.
+
+TaskWarrior commands can take seconds when hooks or sync are involved, so
+database changes are run in a worker thread, one at a time and in the order
+they were submitted, while the GTK main loop keeps running.  Results and
+errors are reported back in the main loop.
+"""
+
+import Queue
+import threading
+
+import gobject
+
+from taskindicator import util
+
+
+class WriteQueue(object):
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.pending = 0
+        self.thread = None
+
+    def __len__(self):
+        """Returns the number of writes which are not finished yet."""
+        return self.pending
+
+    def submit(self, func, args=(), callback=None, errback=None):
+        """Schedules func(*args) to run in the worker thread.  Then either
+        callback(result) or errback(exception) is called in the main
+        loop."""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._worker,
+                                           name="task-writer")
+            self.thread.daemon = True
+            self.thread.start()
+
+        self.pending += 1
+        self.queue.put((func, args, callback, errback))
+        if self.pending > 1:
+            util.log("Write queued, {0} pending.", self.pending)
+
+    def flush(self):
+        """Waits until all writes are done, e.g., before quitting."""
+        if self.pending:
+            util.log("Waiting for {0} writes to finish.", self.pending)
+        self.queue.join()
+
+    def _worker(self):
+        while True:
+            func, args, callback, errback = self.queue.get()
+            try:
+                result = func(*args)
+            except Exception, e:
+                gobject.idle_add(self._done, errback, e, False)
+            else:
+                gobject.idle_add(self._done, callback, result, True)
+            self.queue.task_done()
+
+    def _done(self, handler, value, success):
+        self.pending -= 1
+        if handler is not None:
+            handler(value)
+        elif not success:
+            util.log("Write failed: {0}", value)
+        return False
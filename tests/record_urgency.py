@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# encoding=utf-8
+
+"""
+Records urgency fixtures from TaskWarrior.
+
+Each tests/data/urgency-NAME.json has configuration and tasks, with dates
+given in days relative to now.  The tasks are imported into an empty
+TaskWarrior database with that configuration, exported, and saved to
+tests/data/urgency-NAME.export.json with the time of the export, which
+test_urgency.py checks when it's there.  Needs TaskWarrior; run by hand
+when the urgency formulas change:
+
+    python tests/record_urgency.py
+"""
+
+import glob
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+DATES = ("entry", "due", "scheduled", "wait", "start", "end")
+
+
+def format_date(now, days):
+    ts = now + int(days * 86400)
+    return time.strftime("%Y%m%dT%H%M%SZ", time.gmtime(ts))
+
+
+def record(path):
+    with open(path, "rb") as f:
+        template = json.load(f)
+
+    folder = tempfile.mkdtemp()
+    try:
+        rc = os.path.join(folder, "taskrc")
+        with open(rc, "wb") as f:
+            f.write("data.location=%s\n" % folder)
+            f.write("confirmation=no\n")
+            for k, v in sorted(template["config"].items()):
+                f.write("%s=%s\n" % (k, v))
+
+        env = dict(os.environ, TASKRC=rc, TASKDATA=folder)
+
+        now = int(time.time())
+        tasks = []
+        for task in template["tasks"]:
+            task = dict(task)
+            for k in DATES:
+                if k in task:
+                    task[k] = format_date(now, task[k])
+            for note in task.get("annotations", []):
+                note["entry"] = format_date(now, note["entry"])
+            tasks.append(task)
+
+        p = subprocess.Popen(["task", "rc.hooks=off", "import", "-"],
+                             stdin=subprocess.PIPE, env=env)
+        p.communicate("\n".join(json.dumps(t) for t in tasks))
+
+        output = subprocess.check_output(["task", "rc.hooks=off", "export"],
+                                         env=env)
+        exported = json.loads(output if output.lstrip().startswith("[")
+                              else "[%s]" % output)
+    finally:
+        shutil.rmtree(folder)
+
+    fixture = path[:-5] + ".export.json"
+    with open(fixture, "wb") as f:
+        json.dump({"now": format_date(now, 0),
+                   "config": template["config"],
+                   "tasks": exported}, f, indent=1, sort_keys=True)
+    print("Wrote %s" % fixture)
+
+
+if __name__ == "__main__":
+    for path in sorted(glob.glob(os.path.join(DATA, "urgency-*.json"))):
+        if "." not in os.path.basename(path)[:-5]:
+            record(path)
@@ -0,0 +1,102 @@
+# encoding=utf-8
+
+"""
+Checks that DataFile.refresh picks up every kind of change to a data file,
+parsing only what changed.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(TESTS), "src"))
+
+from taskindicator.database_tw import DataFile
+
+
+def line(uuid, description, status="pending"):
+    return '[description:"%s" entry:"1420070400" status:"%s" uuid:"%s"]\n' \
+        % (description, status, uuid)
+
+
+class DataFileTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "pending.data")
+        self.mtime = 1420070400
+        self.data = DataFile(self.path)
+        self.parsed = []
+
+        parse = self.data.parse
+
+        def counting_parse(line):
+            self.parsed.append(line)
+            return parse(line)
+        self.data.parse = counting_parse
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write(self, contents, mode="wb"):
+        """Writes to the file in place, with a new mtime every time."""
+        with open(self.path, mode) as f:
+            f.write(contents)
+        self.mtime += 1
+        os.utime(self.path, (self.mtime, self.mtime))
+
+    def check(self, descriptions, parsed):
+        self.assertEqual([t["description"] for t in self.data.tasks],
+                         descriptions)
+        self.assertEqual(len(self.parsed), parsed)
+        del self.parsed[:]
+
+    def test_append(self):
+        self.write(line("a", "one") + line("b", "two"))
+        self.assertTrue(self.data.refresh())
+        self.check(["one", "two"], 2)
+
+        self.assertFalse(self.data.refresh())
+
+        self.write(line("c", "three"), "ab")
+        self.assertTrue(self.data.refresh())
+        self.check(["one", "two", "three"], 1)
+
+    def test_edit_same_size(self):
+        self.write(line("a", "one") + line("b", "two") + line("c", "six"))
+        self.data.refresh()
+        self.check(["one", "two", "six"], 3)
+
+        size = os.path.getsize(self.path)
+        self.write(line("a", "one") + line("b", "ten") + line("c", "six"))
+        self.assertEqual(os.path.getsize(self.path), size)
+        self.assertTrue(self.data.refresh())
+        self.check(["one", "ten", "six"], 1)
+
+    def test_truncate(self):
+        self.write(line("a", "one") + line("b", "two"))
+        self.data.refresh()
+        self.check(["one", "two"], 2)
+
+        self.write(line("a", "one"))
+        self.assertTrue(self.data.refresh())
+        self.check(["one"], 1)
+        self.assertEqual(self.data.size, os.path.getsize(self.path))
+
+    def test_partial_line(self):
+        full = line("b", "two")
+        self.write(line("a", "one") + full[:20])
+        self.assertTrue(self.data.refresh())
+        self.check(["one"], 1)
+        self.assertEqual(self.data.size, len(line("a", "one")))
+
+        self.write(full[20:], "ab")
+        self.assertTrue(self.data.refresh())
+        self.check(["one", "two"], 1)
+        self.assertEqual(self.data.size, os.path.getsize(self.path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+# encoding=utf-8
+
+"""
+Checks urgency computed by urgency.py.
+
+Each data/urgency-NAME.json has a configuration and tasks, with dates in
+days relative to now.  urgency-NAME.expected.json has the urgency of each
+task computed by hand from the TaskWarrior 2.4 formulas.  Exports recorded
+from a real TaskWarrior with record_urgency.py, urgency-NAME.export.json,
+are checked too, when there are any.
+"""
+
+import glob
+import json
+import os
+import sys
+import unittest
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(TESTS), "src"))
+
+from taskindicator import urgency
+from taskindicator import util
+from taskindicator.database_tw import Task
+
+
+DATA = os.path.join(TESTS, "data")
+
+TOLERANCE = 0.01
+
+NOW = 1420070400  # 2015-01-01, any time works
+
+DATES = ("entry", "due", "scheduled", "wait", "start", "end")
+
+
+class Config(object):
+    """Stands in for taskrc.TaskRC."""
+
+    def __init__(self, values):
+        self.values = values
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def items(self):
+        return self.values.items()
+
+
+def load(name, suffix=""):
+    with open(os.path.join(DATA, "urgency-%s%s.json" % (name, suffix)),
+              "rb") as f:
+        return json.load(f)
+
+
+def get_templates():
+    names = []
+    for path in glob.glob(os.path.join(DATA, "urgency-*.json")):
+        name = os.path.basename(path)[8:-5]
+        if "." not in name:
+            names.append(name)
+    return sorted(names)
+
+
+def from_template(data, now):
+    """Creates a task from a template, with dates relative to now."""
+    data = dict(data)
+    for k in DATES:
+        if k in data:
+            data[k] = now + int(data[k] * 86400)
+    data["annotations"] = [dict(note, entry=now + int(note["entry"] * 86400))
+                           for note in data.get("annotations", [])]
+    return Task.from_json(data)
+
+
+class UrgencyTest(unittest.TestCase):
+    def check(self, config, tasks, expected, now, name):
+        urgency.Urgency(Config(config)).update(tasks, now)
+        for task in tasks:
+            self.assertAlmostEqual(task["urgency"], expected[task["uuid"]],
+                                   delta=TOLERANCE,
+                                   msg="%s: %s" % (name, task["description"]))
+
+    def check_expected(self, name):
+        template = load(name)
+        tasks = [from_template(data, NOW) for data in template["tasks"]]
+        self.check(template["config"], tasks,
+                   load(name, ".expected")["urgency"], NOW, name)
+
+    def test_default(self):
+        """Age, due, priority, tags, project, active, blocked, blocking,
+        annotations, waiting and scheduled with default coefficients."""
+        self.check_expected("default")
+
+    def test_custom(self):
+        """Priority, age.max=0, user project, tag and keyword, UDA
+        coefficients."""
+        self.check_expected("custom")
+
+    def test_expected(self):
+        """Every template has expected values."""
+        for name in get_templates():
+            self.assertTrue(os.path.exists(os.path.join(
+                DATA, "urgency-%s.expected.json" % name)), name)
+
+    def test_legacy_priority(self):
+        """TaskWarrior before 2.4 scaled fixed priority values with
+        urgency.priority.coefficient."""
+        tasks = [Task(uuid=p, description=p, priority=p, status="pending")
+                 for p in ("H", "L")]
+        self.check({"urgency.priority.coefficient": "10.0",
+                    "urgency.age.coefficient": "0"},
+                   tasks, {"H": 10.0, "L": 3.0}, NOW, "legacy")
+
+    def test_exports(self):
+        """Parity with exports recorded by record_urgency.py."""
+        names = [name for name in get_templates() if os.path.exists(
+            os.path.join(DATA, "urgency-%s.export.json" % name))]
+        if not names:
+            self.skipTest("no exports recorded, see record_urgency.py")
+
+        for name in names:
+            fixture = load(name, ".export")
+            tasks = [Task.from_json(data) for data in fixture["tasks"]]
+            expected = dict((data["uuid"], data["urgency"])
+                            for data in fixture["tasks"])
+            self.check(fixture["config"], tasks, expected,
+                       util.parse_date(fixture["now"]), name)
+
+
+if __name__ == "__main__":
+    unittest.main()